@@ -0,0 +1,220 @@
+#-*- coding:utf-8 -*-
+# Offline CPU benchmark of DNNGP training, prediction and the conversion scripts on synthetic data.
+# For every (samples, markers) point of the grid a seeded synthetic genotype/phenotype set is generated, each task is
+# run in its own subprocess (as users run it) and its wall time, peak memory (RSS of the child) and throughput are
+# written to a JSON results file. --save-baseline stores the results as the baseline; later runs are compared with it
+# and exit with status 1 if a task got slower (or bigger) by more than --tolerance.
+#
+#   python dnngp_benchmark.py --samples 500 2000 --markers 1000 10000 --save-baseline
+#   python dnngp_benchmark.py --samples 500 2000 --markers 1000 10000
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scripts_dir = os.path.join(root_dir, 'Scripts')
+sys.path.insert(0, scripts_dir)
+import dnngp_results
+
+TASKS = ('train', 'predict', 'tsv2pkl', 'hmp2vcf', 'csv2tsv', 'preprocess')
+NUCLEOTIDES = np.array(list('ACGT'))
+
+
+def write_dataset(directory, n_samples, n_markers, seed=123):
+    """Synthetic 0/1/2 genotypes (pkl, tsv, csv, hmp) and a phenotype with 100 additive QTL and heritability 0.5"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    freq = rng.uniform(0.05, 0.5, n_markers)
+    dosage = rng.binomial(2, freq, size=(n_samples, n_markers)).astype(np.int8)
+    samples = [f"S{i + 1}" for i in range(n_samples)]
+    markers = [f"M{j + 1}" for j in range(n_markers)]
+    genotype = pd.DataFrame(dosage.astype(np.float64), index=samples, columns=markers)
+    genotype.to_pickle(os.path.join(directory, 'genotype.pkl'))
+    genotype.index.name = 'ID'
+    genotype.to_csv(os.path.join(directory, 'genotype.tsv'), sep='\t')
+    genotype.to_csv(os.path.join(directory, 'genotype.csv'))
+
+    effects = np.zeros(n_markers)
+    qtl = rng.choice(n_markers, min(100, n_markers), replace=False)
+    effects[qtl] = rng.normal(size=len(qtl))
+    genetic = (dosage - 2 * freq) @ effects
+    noise = rng.normal(scale=genetic.std() or 1.0, size=n_samples)
+    pd.DataFrame({'env1': genetic + noise}, index=pd.Index(samples, name='ID')).to_csv(
+        os.path.join(directory, 'pheno.tsv'), sep='\t')
+
+    alleles = np.array([rng.choice(NUCLEOTIDES, 2, replace=False) for _ in range(n_markers)])
+    with open(os.path.join(directory, 'genotype.hmp.txt'), 'w') as f:
+        f.write('\t'.join(['rs#', 'alleles', 'chrom', 'pos', 'strand', 'assembly#', 'center', 'protLSID',
+                           'assayLSID', 'panelLSID', 'QCcode'] + samples) + '\n')
+        for j, (ref, alt) in enumerate(alleles):
+            tokens = np.array([ref + ref, ref + alt, alt + alt])[dosage[:, j]]
+            f.write('\t'.join([markers[j], f"{ref}/{alt}", '1', str(j + 1), '+'] + ['NA'] * 6) + '\t'
+                    + '\t'.join(tokens) + '\n')
+
+
+def high_water_mb(pid):
+    """Peak resident memory of a running process in MB (Linux only, None elsewhere)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def run(command, log_file, env=None, interval=0.02):
+    """Run a command, returning (returncode, wall seconds, peak RSS of the child in MB or None)"""
+    start = time.time()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=scripts_dir)
+        if os.path.exists(f'/proc/{process.pid}/status'):
+            # Linux: the child's rusage starts from the RSS of this (forked) process, VmHWM is the child's own peak
+            peak = None
+            while process.poll() is None:
+                peak = max(peak or 0, high_water_mb(process.pid) or 0) or None
+                time.sleep(interval)
+        elif hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak = usage.ru_maxrss / (1 << 20)  # bytes on macOS
+        else:
+            process.wait()
+            peak = None
+    return process.returncode, time.time() - start, peak
+
+
+def task_commands(task, data, work, n_samples, n_markers, opt):
+    """(command, units processed, unit name) of a task"""
+    python = sys.executable
+    if task == 'train':
+        return ([python, os.path.join(scripts_dir, 'dnngp_runner.py'), '--batch_size', str(opt.batch_size),
+                 '--lr', '0.001', '--epoch', str(opt.epochs), '--patience', '5', '--dropout1', '0.5', '--dropout2', '0.3',
+                 '--seed', '123', '--cv', '5', '--part', '1', '--earlystopping', str(opt.epochs),
+                 '--snp', os.path.join(data, 'genotype.pkl'), '--pheno', os.path.join(data, 'pheno.tsv'),
+                 '--output', os.path.join(work, '')], n_samples * 4 // 5, 'training samples/s per epoch')
+    if task == 'predict':
+        return ([python, os.path.join(scripts_dir, 'Pre_runner.py'),
+                 '--Model', os.path.join(os.path.dirname(work), 'train', 'training.model.h5'),
+                 '--SNP', os.path.join(data, 'genotype.pkl'), '--output', os.path.join(work, '')],
+                n_samples, 'samples/s')
+    if task == 'tsv2pkl':
+        code = (f"import sys; sys.path.insert(0, {os.path.join(root_dir, 'Input_files')!r}); import tsv2pkl; "
+                f"tsv2pkl.convert({os.path.join(data, 'genotype.tsv')!r}, {os.path.join(work, 'tsv2pkl.pkl')!r})")
+        return [python, '-c', code], n_samples * n_markers, 'genotypes/s'
+    if task == 'hmp2vcf':
+        return ([python, os.path.join(root_dir, 'trans', 'hmp2vcf.py'), os.path.join(data, 'genotype.hmp.txt'),
+                 os.path.join(work, 'genotype.vcf'), '--workers', str(opt.workers)], n_samples * n_markers, 'genotypes/s')
+    if task == 'csv2tsv':
+        return ([python, os.path.join(root_dir, 'trans', 'csv2tsv.py'), os.path.join(data, 'genotype.csv'),
+                 os.path.join(work, 'csv2tsv.tsv')], n_samples * n_markers, 'values/s')
+    if task == 'preprocess':
+        return ([python, os.path.join(root_dir, 'data_clean', 'data_preprocessing.py'),
+                 os.path.join(data, 'genotype.pkl'), os.path.join(data, 'pheno.tsv'), os.path.join(work, 'aligned')],
+                n_samples * n_markers, 'genotypes/s')
+    raise ValueError(f"unknown task {task}")
+
+
+def benchmark_point(n_samples, n_markers, tasks, opt):
+    directory = os.path.join(opt.work_dir, f"{n_samples}x{n_markers}")
+    data = os.path.join(directory, 'data')
+    print(f"== {n_samples} samples x {n_markers} markers", flush=True)
+    write_dataset(data, n_samples, n_markers, opt.seed)
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='', PYTHONUNBUFFERED='1')  # CPU only
+    results = []
+    for task in tasks:
+        work = os.path.join(directory, task)
+        os.makedirs(work, exist_ok=True)
+        if task == 'predict' and not os.path.exists(os.path.join(directory, 'train', 'training.model.h5')):
+            print("  predict: skipped, needs the model of the train task", flush=True)
+            continue
+        command, units, unit = task_commands(task, data, work, n_samples, n_markers, opt)
+        returncode, wall, peak = run(command, os.path.join(directory, f"{task}.log"), env)
+        result = {'task': task, 'samples': n_samples, 'markers': n_markers, 'returncode': returncode,
+                  'wall_seconds': wall, 'peak_rss_mb': peak}
+        if task == 'train' and returncode == 0:
+            records = dnngp_results.read_records(os.path.join(work, dnngp_results.RESULT_FILE))
+            epochs = records[-1].get('epochs_run') if records else None
+            result['epochs_run'] = epochs
+            units = units * epochs if epochs else None
+        result['throughput'] = units / wall if units and returncode == 0 else None
+        result['unit'] = unit
+        print(f"  {task}: {'ok' if returncode == 0 else 'FAILED'} {wall:.2f} s, peak {peak} MB", flush=True)
+        results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds=1.0):
+    """Tasks slower or bigger than the baseline by more than tolerance (fraction); runs shorter than min_seconds are
+    too noisy for their wall time to count"""
+    reference = {(r['task'], r['samples'], r['markers']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = reference.get((result['task'], result['samples'], result['markers']))
+        if base is None or result['returncode'] != 0 or base['returncode'] != 0:
+            continue
+        for metric in ('wall_seconds', 'peak_rss_mb'):
+            if result.get(metric) and base.get(metric):
+                ratio = result[metric] / base[metric]
+                result[f'{metric}_vs_baseline'] = ratio
+                if ratio > 1 + tolerance and (metric != 'wall_seconds' or base[metric] >= min_seconds):
+                    regressions.append(f"{result['task']} {result['samples']}x{result['markers']}: "
+                                       f"{metric} {base[metric]:.2f} -> {result[metric]:.2f} ({ratio:.2f}x)")
+    return regressions
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='DNNGP benchmark on synthetic data')
+    parser.add_argument('--samples', type=int, nargs='+', default=[500, 2000], help='sample counts of the grid')
+    parser.add_argument('--markers', type=int, nargs='+', default=[1000, 10000], help='marker counts of the grid')
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=list(TASKS))
+    parser.add_argument('--epochs', type=int, default=5, help='training epochs, default=5')
+    parser.add_argument('--batch_size', type=int, default=64, help='training batch size, default=64')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='hmp2vcf worker processes')
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--work_dir', default=os.path.join(root_dir, 'Benchmark', 'work'),
+                        help='synthetic data and task outputs, default=Benchmark/work')
+    parser.add_argument('--output', default=os.path.join(root_dir, 'Benchmark', 'results.json'),
+                        help='results file, default=Benchmark/results.json')
+    parser.add_argument('--baseline', default=os.path.join(root_dir, 'Benchmark', 'baseline.json'),
+                        help='baseline file, default=Benchmark/baseline.json')
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing with it')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown/growth, default=0.2 (20%%)')
+    parser.add_argument('--min_seconds', type=float, default=1.0,
+                        help='wall times below this in the baseline are not compared, default=1.0')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = get_options()
+    results = []
+    for n_samples in opt.samples:
+        for n_markers in opt.markers:
+            results.extend(benchmark_point(n_samples, n_markers, opt.tasks, opt))
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+              'options': vars(opt), 'results': results}
+    regressions = []
+    if not opt.save_baseline and os.path.exists(opt.baseline):
+        with open(opt.baseline) as f:
+            regressions = compare(results, json.load(f), opt.tolerance, opt.min_seconds)
+        report['baseline'] = opt.baseline
+        report['regressions'] = regressions
+    with open(opt.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results save in: {opt.output}")
+    if opt.save_baseline:
+        shutil.copyfile(opt.output, opt.baseline)
+        print(f"Baseline save in: {opt.baseline}")
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    failed = [r for r in results if r['returncode'] != 0]
+    sys.exit(1 if regressions or failed else 0)
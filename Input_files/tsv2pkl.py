@@ -1,33 +1,77 @@
 #When eigenvec or tsv are converted to PKL, the PANDAS version and model version should be the same as DNNGP.
 #So, please run the program in a DNNGP environment.
+import os
+import sys
+import numpy as np
 import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+import genotype_store
 ########Set path section
 inpath=r"C:\Users\Cloud\Desktop\ai_homework\data\Maize_SelfingPrediction_Example\data_need\maize1k.train.eigenvec" #Set input path
 outpath=r"C:\Users\Cloud\Desktop\ai_homework\data\Maize_SelfingPrediction_Example\data_need\maize1k.train.pkl" #Set output path
+out_format="pkl" #"pkl": pickled DataFrame. "npy": memory-mapped genotype store (outpath with .npy plus .samples.txt/.markers.txt), see Scripts/genotype_store.py
+out_dtype=None #Matrix type, default float64 for "pkl" (like the shipped pkl files) and float32 for "npy". "float32" halves the pkl size; "int8" for 0/1/2 dosages without missing values (only with out_format="npy").
+chunk_rows=1000 #Rows (samples) parsed at a time. With out_format="npy" peak memory only depends on this, not on the file size.
 
 ########Conversion format section
-inpath=inpath.replace('\\','/') #Replace '\' with '/' in the input path.
-outpath=outpath.replace('\\','/') #Replace '\' with '/' in the output path.
-if "eigenvec" in inpath:
-    # 先读取文件检查结构
-    Gene = pd.read_csv(inpath, sep='\t', header=0)
-    
-    # 如果第一列是#FID，第二列是#IID或IID，使用第二列作为index
-    if '#FID' in Gene.columns or Gene.columns[0] == '#FID':
-        Gene = pd.read_csv(inpath, sep='\t', header=0, index_col=1)
-        if '#FID' in Gene.columns:
-            del Gene['#FID']
-    # 如果第一列是#IID或IID，使用第一列作为index
-    elif '#IID' in Gene.columns or 'IID' in Gene.columns or Gene.columns[0] in ['#IID', 'IID']:
-        Gene = pd.read_csv(inpath, sep='\t', header=0, index_col=0)
+def read_header(path, sep):
+    """Column names of the first line, the file is not read any further"""
+    with open(path, 'r') as f:
+        return f.readline().rstrip('\r\n').split(sep)
+
+def count_rows(path, sep):
+    """Number of data lines (without header) that pd.read_csv parses into rows
+
+    Like read_csv, lines of only whitespace are skipped, but a line holding a separator is an (empty) row.
+    """
+    separator = sep.encode()
+    lines = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip() or separator in line:
+                lines += 1
+    return lines - 1
+
+def convert(inpath, outpath, out_format="pkl", out_dtype=None, chunk_rows=1000):
+    inpath=inpath.replace('\\','/') #Replace '\' with '/' in the input path.
+    outpath=outpath.replace('\\','/') #Replace '\' with '/' in the output path.
+    sep = ',' if "csv" in inpath and "eigenvec" not in inpath else '\t'
+    header = read_header(inpath, sep)
+    index_col = 0
+    drop = []
+    if "eigenvec" in inpath and '#FID' in header:
+        # 如果第一列是#FID，第二列是#IID或IID，使用第二列作为index
+        index_col = 1
+        drop = ['#FID']
+    # 其他情况(#IID/IID或默认)使用第一列作为index
+    markers = [c for i, c in enumerate(header) if i != index_col and c not in drop]
+    if out_dtype is None:
+        out_dtype = "float64" if out_format == "pkl" else "float32"
+    # Markers are parsed straight into the target float type (float32 also for int8, which is rounded when written).
+    dtypes = {c: np.float64 if out_dtype == "float64" else np.float32 for c in markers}
+    reader = pd.read_csv(inpath, sep=sep, header=0, index_col=index_col, dtype=dtypes, chunksize=chunk_rows)
+
+    if out_format == "npy":
+        n_rows = count_rows(inpath, sep)
+        writer = genotype_store.Writer(os.path.splitext(outpath)[0] + ".npy", n_rows, markers, dtype=out_dtype)
+        done = 0
+        for chunk in reader:
+            chunk = chunk.drop(columns=drop)
+            values = chunk.to_numpy()
+            if out_dtype == "int8" and np.isnan(values).any():
+                # int8 has no missing value, impute first (e.g. trans/geno2dosage.py or data_clean/data_preprocessing.py)
+                raise ValueError(f"{inpath}: missing values in rows {done + 1}-{done + len(chunk)} cannot be stored as int8, use out_dtype=\"float32\"")
+            writer.append(list(chunk.index), values)
+            done += len(chunk)
+            print(f"{done}/{n_rows} rows converted")
+        writer.close() #output genotype store
     else:
-        # 默认使用第一列作为index
-        Gene = pd.read_csv(inpath, sep='\t', header=0, index_col=0)
-    
-    Gene.to_pickle(outpath) #output pkl file
-elif "csv" in inpath:
-    Gene = pd.read_csv(inpath, sep=',',header=0,index_col=0) #read csv file.
-    Gene.to_pickle(outpath) #output pkl file
-else:
-    Gene = pd.read_csv(inpath, sep='\t',header=0,index_col=0) #read tsv file.
-    Gene.to_pickle(outpath) #output pkl file
+        chunks = []
+        for chunk in reader:
+            chunks.append(chunk.drop(columns=drop))
+            print(f"{sum(len(c) for c in chunks)} rows read")
+        Gene = pd.concat(chunks)
+        Gene.to_pickle(outpath) #output pkl file
+
+if __name__ == '__main__':
+    convert(inpath, outpath, out_format, out_dtype, chunk_rows)
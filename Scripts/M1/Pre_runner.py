@@ -1,13 +1,42 @@
-import time
+import time,sys
+import os
+import argparse
+# The shared pure-Python helpers (genotype_store.py, ...) live in the parent Scripts directory.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dnngp_profile #在Pre_config_dnngp/Pre_dnngp之前导入，以便统计TensorFlow的导入时间
 import Pre_config_dnngp, Pre_dnngp #导入的设置文件和dnngp.pyx文件
+import genotype_store
+import dnngp_predict
 
 if __name__ == '__main__': #以文件形式而非导入形式运行则下方代码进行。
     start_model = time.time()
+    profiler = dnngp_profile.from_argv() #--profile/--trace: 分阶段计时和TensorFlow profiler跟踪
+    # 流式预测的参数不属于Pre_config_dnngp，先从命令行中取出。
+    extra = argparse.ArgumentParser(add_help=False)
+    extra.add_argument('--chunk_size', type=int, default=None,
+                       help='按块读取候选群体并逐块追加预测结果，内存不随样本数增长；默认不分块(使用Pre_dnngp.main)')
+    extra.add_argument('--batch_size', type=int, default=1024, help='流式预测时每次前向计算的样本数，默认1024')
+    extra.add_argument('--stream_format', choices=['csv', 'npy'], default='csv',
+                       help='流式预测的输出: Prediction.ALL.csv，或Prediction.ALL.npy(float32)+Prediction.ALL.samples.txt')
+    extra_opt, sys.argv[1:] = extra.parse_known_args()
     opt = Pre_config_dnngp.get_options()
     SNP = opt.SNP
     output = opt.output
     model=opt.Model
-    Pre_dnngp.prepare() #运行dnngp.pyx中的环境函数，进行运行环境的设置。
-    Pre_dnngp.main(SNP, model,output) #将参数传入dnngp中。
+    genotype_store.install_reader() #--SNP也可以是内存映射的基因型文件(.npy)。
+    profiler.instrument(Pre_dnngp, dnngp_predict)
+    with profiler.phase('prepare'):
+        Pre_dnngp.prepare() #运行dnngp.pyx中的环境函数，进行运行环境的设置。
+    if extra_opt.chunk_size:
+        #逐块读取(.npy/.tsv)、预测并追加写出，下一块的读取与当前块的计算重叠。
+        output_file = os.path.join(output, 'Prediction.ALL.' + extra_opt.stream_format)
+        with profiler.phase('main'):
+            n = dnngp_predict.predict_stream(dnngp_predict.load_model(model), SNP, output_file,
+                                             extra_opt.chunk_size, extra_opt.batch_size)
+        print(f"{n} predictions save in: {output_file}")
+    else:
+        with profiler.phase('main'):
+            Pre_dnngp.main(SNP, model,output) #将参数传入dnngp中。
+    profiler.save()
     end_model = time.time()
     print('Running time: %s Seconds' % (end_model - start_model))
\ No newline at end of file
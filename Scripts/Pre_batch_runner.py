@@ -0,0 +1,91 @@
+#-*- coding:utf-8 -*-
+# Batch prediction in one process: the genotype file is read once and every model of a list/glob is run over it,
+# e.g. all K fold models of a cross-validation, instead of one Pre_runner.py subprocess per model.
+# The combined table has one column per model and, for each --Model group, the ensemble mean and SD.
+#
+#   python Pre_batch_runner.py --SNP ../Input_files/wheat599_pc95.pkl --output ../Output_files/ \
+#       --Model "trait1=../Output_files/trait1/fold*/training.model.h5" --Model "trait2=../Output_files/trait2/*.h5"
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import pandas as pd
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+import dnngp_predict
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='DNNGP batch and ensemble prediction')
+    parser.add_argument('--Model', action='append', required=True,
+                        help='[name=]path or glob of .h5 models; repeat for several groups (e.g. one per trait)')
+    parser.add_argument('--SNP', required=True, help='genotype file (.pkl or .npy genotype store)')
+    parser.add_argument('--output', required=True, help='output directory')
+    parser.add_argument('--batch_size', type=int, default=1024, help='rows per forward pass, default=1024')
+    parser.add_argument('--output_file', default='Prediction.ensemble.csv',
+                        help='name of the combined table, default=Prediction.ensemble.csv')
+    return parser.parse_args()
+
+
+def expand_group(spec):
+    """'[name=]glob' -> (name, {column label: model path}); labels are the paths relative to the models' common
+    directory, the name defaults to that directory's name"""
+    name, pattern = spec.split('=', 1) if '=' in spec else (None, spec)
+    paths = [os.path.abspath(p) for p in sorted(glob.glob(pattern))]
+    if not paths:
+        raise FileNotFoundError(f"no model matches {pattern}")
+    common = os.path.commonpath([os.path.dirname(p) for p in paths])
+    labels = [os.path.splitext(os.path.relpath(p, common))[0].replace(os.sep, '/') for p in paths]
+    return name or os.path.basename(common), dict(zip(labels, paths))
+
+
+def predict_models(values, models, batch_size):
+    """Run each model over the same array; the session is cleared between models to keep memory flat"""
+    import tensorflow as tf
+    predictions = {}
+    for label, path in models.items():
+        start = time.time()
+        model = dnngp_predict.load_model(path)
+        if dnngp_predict.input_width(model) != values.shape[1]:
+            raise ValueError(f"{path} expects {dnngp_predict.input_width(model)} markers, the genotype file has {values.shape[1]}")
+        predictions[label] = dnngp_predict.predict_array(model, values, batch_size)
+        del model
+        tf.keras.backend.clear_session()
+        print(f"{path}: {time.time() - start:.1f} Seconds")
+    return predictions
+
+
+def ensemble_table(ids, groups):
+    """Per-model columns plus <group>.mean and <group>.sd (column names are prefixed with the group if there are several)"""
+    table = pd.DataFrame(index=pd.Index(ids, name='ID'))
+    for name, predictions in groups.items():
+        prefix = f"{name}." if len(groups) > 1 else ''
+        frame = pd.DataFrame(predictions, index=table.index)
+        for label in frame.columns:
+            table[prefix + label] = frame[label]
+        table[prefix + 'mean'] = frame.mean(axis=1)
+        table[prefix + 'sd'] = frame.std(axis=1) if frame.shape[1] > 1 else 0.0
+    return table
+
+
+if __name__ == '__main__':
+    start_model = time.time()
+    opt = get_options()
+    groups = dict(expand_group(spec) for spec in opt.Model)
+    if len(groups) != len(opt.Model):
+        raise ValueError("model groups need distinct names, use --Model name=glob")
+    import Pre_dnngp
+    Pre_dnngp.prepare()  # same TensorFlow environment settings as Pre_runner.py
+    genotype = dnngp_predict.read_genotype(opt.SNP)
+    values = np.asarray(genotype.to_numpy(), dtype=np.float32)
+    print(f"{opt.SNP}: {values.shape[0]} samples, {values.shape[1]} markers")
+    predictions = {name: predict_models(values, models, opt.batch_size) for name, models in groups.items()}
+    table = ensemble_table(list(genotype.index), predictions)
+    os.makedirs(opt.output, exist_ok=True)
+    output_file = os.path.join(opt.output, opt.output_file)
+    table.to_csv(output_file)
+    print(f"{sum(len(m) for m in groups.values())} models, predictions save in: {output_file}")
+    end_model = time.time()
+    print('Running time: %s Seconds' % (end_model - start_model))
@@ -0,0 +1,223 @@
+#-*- coding:utf-8 -*-
+# Long-lived prediction service: the models are loaded once and stay in memory, genotype rows are posted as JSON.
+# Rows of concurrent requests for the same model are collected into one forward pass (micro-batching).
+#
+#   python Pre_server.py --Model wheat=../Output_files/training.model.h5 --port 8501
+#   curl -s localhost:8501/predict -d '{"model": "wheat", "ids": ["M1"], "genotypes": [[0.1, -2.3, ...]]}'
+#
+# Endpoints
+#   GET  /health    -> {"status": "ok"}
+#   GET  /models    -> {name: {"path": ..., "markers": n}}
+#   POST /predict   {"model": name (optional with one model), "ids": [...], "genotypes": [[...], ...],
+#                    "markers": [...] (optional, reorders the columns when the server knows the model's marker order)}
+#                   -> {"model": name, "ids": [...], "predictions": [...]}
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+import dnngp_predict
+import genotype_store
+
+
+class ModelWorker(threading.Thread):
+    """Owns one model; requests are queued and run in batches of up to max_batch rows"""
+
+    def __init__(self, name, path, markers=None, max_batch=256, max_wait=0.005):
+        super().__init__(name=f"model-{name}", daemon=True)
+        self.path = path
+        self.model = dnngp_predict.load_model(path)
+        self.width = dnngp_predict.input_width(self.model)
+        self.markers = markers
+        self.position = {marker: i for i, marker in enumerate(markers)} if markers else None
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.rows = 0
+        dnngp_predict.predict_array(self.model, np.zeros((1, self.width), dtype=np.float32))  # warm-up, builds the graph
+
+    def align(self, values, markers):
+        """Reorder posted columns to the model's marker order"""
+        if markers is None:
+            return values
+        if self.position is None:
+            raise ValueError("the server does not know the marker order of this model, start it with --markers")
+        columns = [self.position.get(marker) for marker in markers]
+        if len(columns) != self.width or any(c is None for c in columns) or len(set(columns)) != self.width:
+            raise ValueError("posted markers do not match the markers of the model")
+        aligned = np.empty_like(values)
+        aligned[:, columns] = values
+        return aligned
+
+    def submit(self, values, markers=None):
+        values = np.asarray(values, dtype=np.float32)
+        if values.ndim != 2 or values.shape[1] != self.width:
+            raise ValueError(f"expected rows of {self.width} markers, got array of shape {values.shape}")
+        future = Future()
+        self.requests.put((self.align(values, markers), future))
+        return future
+
+    def collect(self):
+        """Block for the first request, then take whatever arrives within max_wait up to max_batch rows"""
+        batch = [self.requests.get()]
+        rows = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                predictions = dnngp_predict.predict_array(self.model, np.concatenate([values for values, _ in batch]),
+                                                          self.max_batch)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            start = 0
+            for values, future in batch:
+                future.set_result(predictions[start:start + len(values)])
+                start += len(values)
+            self.rows += start
+
+
+def read_markers(path):
+    """Marker order of a model from a .markers.txt list, a genotype store (.npy) or a pickled DataFrame"""
+    if genotype_store.is_store(path):
+        path = genotype_store.sidecar_paths(path)[1]
+    if path.endswith('.txt'):
+        with open(path) as f:
+            return [line.rstrip('\n') for line in f]
+    return [str(c) for c in dnngp_predict.read_genotype(path).columns]
+
+
+def name_value(spec):
+    """'name=path' -> (name, path); a bare path is named after the file"""
+    if '=' in spec:
+        name, path = spec.split('=', 1)
+        return name, path
+    return os.path.splitext(os.path.basename(spec.rstrip('/')))[0], spec
+
+
+class Handler(BaseHTTPRequestHandler):
+    workers = {}
+    timeout_seconds = 60
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/models':
+            self.send_json(200, {name: {'path': w.path, 'markers': w.width, 'batches': w.batches, 'rows': w.rows}
+                                 for name, w in self.workers.items()})
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            name = request.get('model')
+            if name is None and len(self.workers) == 1:
+                name = next(iter(self.workers))
+            if name not in self.workers:
+                raise KeyError(f"unknown model {name!r}, loaded: {sorted(self.workers)}")
+            genotypes = request['genotypes']
+            ids = request.get('ids', list(range(len(genotypes))))
+            if len(ids) != len(genotypes):
+                raise ValueError("ids and genotypes have different lengths")
+            future = self.workers[name].submit(genotypes, request.get('markers'))
+            predictions = future.result(timeout=self.timeout_seconds)
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'model': name, 'ids': ids, 'predictions': np.asarray(predictions).tolist()})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = socket.gethostname(), 0
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='DNNGP prediction server')
+    parser.add_argument('--Model', action='append', required=True,
+                        help='model to serve as name=path (repeat for several models), e.g. wheat=../Output_files/training.model.h5')
+    parser.add_argument('--markers', action='append', default=[],
+                        help='marker order of a model as name=path (.markers.txt, .npy or .pkl), needed for requests with "markers"')
+    parser.add_argument('--host', default='127.0.0.1', help='default=127.0.0.1')
+    parser.add_argument('--port', type=int, default=8501, help='default=8501')
+    parser.add_argument('--unix_socket', default=None, help='listen on this Unix socket instead of host:port')
+    parser.add_argument('--max_batch', type=int, default=256, help='most rows per forward pass, default=256')
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='how long a batch waits for more requests, default=5')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = get_options()
+    import Pre_dnngp
+    Pre_dnngp.prepare()  # same TensorFlow environment settings as Pre_runner.py
+    markers = dict(name_value(spec) for spec in opt.markers)
+    workers = {}
+    for spec in opt.Model:
+        name, path = name_value(spec)
+        start = time.time()
+        workers[name] = ModelWorker(name, path, read_markers(markers[name]) if name in markers else None,
+                                    opt.max_batch, opt.max_wait_ms / 1000)
+        workers[name].start()
+        print(f"Model {name} loaded from {path} ({workers[name].width} markers) in {time.time() - start:.1f} Seconds")
+    Handler.workers = workers
+    if opt.unix_socket:
+        server = UnixHTTPServer(opt.unix_socket, Handler)
+        print(f"Serving on unix:{opt.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), Handler)
+        print(f"Serving on http://{opt.host}:{opt.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,209 @@
+#-*- coding:utf-8 -*-
+# Checkpoint/resume and warm start of DNNGP training runs (--checkpoint_every N, --resume, --init_from model.h5).
+# Every N epochs the weights and optimizer slots (a tf.train checkpoint), the state of the EarlyStopping and
+# ReduceLROnPlateau callbacks (including the best weights kept for restore_best_weights), the learning rate and the
+# history so far are written to <output>/checkpoint/. --resume continues an interrupted run from there with
+# initial_epoch, and a finished run is not trained again. --init_from copies the weights of a trained model of the
+# same architecture into the new network before training, layer by layer in order, instead of the TruncatedNormal init.
+# The compiled dnngp.main is covered by routing Model.fit through Checkpointer.fit (see install()).
+import os
+import json
+import argparse
+import functools
+import numpy as np
+import tensorflow as tf
+from dnngp_profile import fit_arguments
+
+STATE_FILE = 'state.json'
+BEST_WEIGHTS_FILE = 'best_weights.npz'
+CALLBACK_STATE = ('wait', 'best', 'stopped_epoch', 'best_epoch', 'cooldown_counter')
+
+
+def add_options(parser):
+    parser.add_argument('--checkpoint_every', type=int, default=None,
+                        help='save a checkpoint every N epochs into <output>/checkpoint/, default=off (10 with --resume)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the checkpoint in <output>/checkpoint/ if there is one')
+    parser.add_argument('--init_from', default=None,
+                        help='trained model (.h5) whose matching layers initialize the network (warm start)')
+
+
+def from_argv():
+    """Take the checkpoint options off sys.argv (before config_dnngp parses it) and return a Checkpointer"""
+    import sys
+    parser = argparse.ArgumentParser(add_help=False)
+    add_options(parser)
+    opt, sys.argv[1:] = parser.parse_known_args()
+    return Checkpointer(opt.checkpoint_every, opt.resume, opt.init_from)
+
+
+def _write_json(path, data):
+    """Write through a temporary file, so an interrupted write never leaves a broken state file"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _json_value(value):
+    value = np.asarray(value).item() if isinstance(value, (np.generic, np.ndarray)) else value
+    return float(value) if isinstance(value, float) else value
+
+
+def warm_start(model, path):
+    """Copy the weights of a trained model into model, pairing the layers that have weights in order
+
+    Layer names are generated per session (dense_3, conv1d_7, ...), so layers are matched by position, and each pair
+    must have the same layer type and weight shapes. Raises ValueError, before any weight is changed, when the two
+    networks differ. Returns the names of the initialized layers.
+    """
+    source = tf.keras.models.load_model(path, compile=False)
+    layers = [layer for layer in model.layers if layer.weights]
+    source_layers = [layer for layer in source.layers if layer.weights]
+    pairs = []
+    mismatched = []
+    for layer, other in zip(layers, source_layers):
+        weights = other.get_weights()
+        if type(layer) is type(other) and [w.shape for w in layer.weights] == [w.shape for w in weights]:
+            pairs.append((layer, weights))
+        else:
+            mismatched.append(f"{layer.name} ({type(layer).__name__} {[tuple(w.shape) for w in layer.weights]}) vs "
+                              f"{other.name} ({type(other).__name__} {[w.shape for w in weights]})")
+    if mismatched or len(layers) != len(source_layers):
+        raise ValueError(f"Cannot warm start from {path}: {len(pairs)} of {len(layers)} layers with weights match "
+                         f"({len(source_layers)} in the trained model)" + (f"; mismatched: {mismatched}" if mismatched else ''))
+    for layer, weights in pairs:
+        layer.set_weights(weights)
+    print(f"Warm start from {path}: {len(pairs)} layers initialized")
+    return [layer.name for layer, _ in pairs]
+
+
+class Checkpoint(tf.keras.callbacks.Callback):
+    """Saves model, optimizer, callback state and history every `every` epochs and at the end of training
+
+    callbacks: the EarlyStopping/ReduceLROnPlateau instances of the same fit(); their state is saved, and restored
+    in on_train_begin (after they reset themselves, as this callback comes after them).
+    """
+
+    def __init__(self, directory, callbacks=None, every=10):
+        super().__init__()
+        self.directory = directory
+        self.every = every
+        self.tracked = [c for c in callbacks or [] if isinstance(c, (tf.keras.callbacks.EarlyStopping,
+                                                                       tf.keras.callbacks.ReduceLROnPlateau))]
+        self.epoch = 0
+        self.history = {}
+        self.finished = False
+        self.state = None
+
+    def _checkpoint(self, model):
+        return tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+
+    def restore(self, model):
+        """Load the last checkpoint into model; False if the directory has none"""
+        state_file = os.path.join(self.directory, STATE_FILE)
+        if not os.path.exists(state_file):
+            return False
+        with open(state_file) as f:
+            self.state = json.load(f)
+        self._checkpoint(model).restore(os.path.join(self.directory, self.state['checkpoint'])).expect_partial()
+        if self.state.get('lr') is not None and model.optimizer is not None:
+            tf.keras.backend.set_value(model.optimizer.lr, self.state['lr'])
+        self.epoch = self.state['epoch']
+        self.history = {k: v[:self.epoch] for k, v in self.state['history'].items()}
+        self.finished = self.state['finished']
+        return True
+
+    def on_train_begin(self, logs=None):
+        if not self.state:
+            return
+        best_weights = os.path.join(self.directory, BEST_WEIGHTS_FILE)
+        for callback, saved in zip(self.tracked, self.state['callbacks']):
+            for attribute, value in saved.items():
+                setattr(callback, attribute, value)
+            if isinstance(callback, tf.keras.callbacks.EarlyStopping) and os.path.exists(best_weights):
+                with np.load(best_weights) as f:
+                    callback.best_weights = [f[f"arr_{i}"] for i in range(len(f.files))]
+
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(_json_value(value))
+        self.epoch = epoch + 1
+        if self.epoch % self.every == 0:
+            self.save()
+
+    def on_train_end(self, logs=None):
+        self.finished = True
+        self.save()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._checkpoint(self.model).write(os.path.join(self.directory, f"ckpt-{self.epoch}"))
+        callbacks = []
+        for callback in self.tracked:
+            callbacks.append({a: _json_value(getattr(callback, a)) for a in CALLBACK_STATE if hasattr(callback, a)})
+            best = getattr(callback, 'best_weights', None)
+            if best is not None:
+                with open(os.path.join(self.directory, BEST_WEIGHTS_FILE + '.tmp'), 'wb') as f:
+                    np.savez(f, *best)
+                os.replace(os.path.join(self.directory, BEST_WEIGHTS_FILE + '.tmp'),
+                           os.path.join(self.directory, BEST_WEIGHTS_FILE))
+        previous = self.state['checkpoint'] if self.state else None
+        self.state = {'epoch': self.epoch, 'finished': self.finished, 'checkpoint': os.path.basename(path),
+                      'lr': _json_value(tf.keras.backend.get_value(self.model.optimizer.lr)),
+                      'callbacks': callbacks, 'history': self.history}
+        _write_json(os.path.join(self.directory, STATE_FILE), self.state)
+        if previous and previous != self.state['checkpoint']:  # the state file now points to the new checkpoint
+            for name in os.listdir(self.directory):
+                if name.startswith(previous + '.'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+class Checkpointer:
+    """Checkpoint and warm-start settings of a run; fit() is a plain Model.fit when neither was requested"""
+
+    def __init__(self, every=None, resume=False, init_from=None, directory=None):
+        self.every = every or (10 if resume else 0)
+        self.resume = resume
+        self.init_from = init_from
+        self.directory = directory
+        self.enabled = bool(self.every or init_from)
+
+    def fit(self, model, *args, fit=None, **kwargs):
+        """model.fit(*args, **kwargs) with warm start, checkpoints and resume; the returned history covers the
+        epochs of the resumed run as well"""
+        fit = fit or tf.keras.Model.fit
+        if self.init_from:
+            warm_start(model, self.init_from)
+        if not self.every:
+            return fit(model, *args, **kwargs)
+        # callbacks and initial_epoch may also be given positionally, so take all arguments by name
+        kwargs = fit_arguments(fit, model, *args, **kwargs)
+        checkpoint = Checkpoint(self.directory, kwargs.get('callbacks'), self.every)
+        if self.resume and checkpoint.restore(model):
+            print(f"Resume from epoch {checkpoint.epoch} of {self.directory}")
+            if checkpoint.finished:
+                print("The checkpointed run had finished, it is not trained again")
+                history = tf.keras.callbacks.History()
+                history.set_model(model)
+                history.history = checkpoint.history
+                history.epoch = list(range(checkpoint.epoch))
+                return history
+            kwargs['initial_epoch'] = checkpoint.epoch
+        kwargs['callbacks'] = list(kwargs.get('callbacks') or []) + [checkpoint]
+        history = fit(model, **kwargs)
+        history.history = checkpoint.history
+        history.epoch = list(range(checkpoint.epoch))
+        return history
+
+    def install(self):
+        """Route every Model.fit through fit(), e.g. the one inside the compiled dnngp.main"""
+        if not self.enabled:
+            return
+        checkpointer = self
+        fit = tf.keras.Model.fit
+
+        @functools.wraps(fit)
+        def checkpointed_fit(model, *args, **kwargs):
+            return checkpointer.fit(model, *args, fit=fit, **kwargs)
+
+        tf.keras.Model.fit = checkpointed_fit
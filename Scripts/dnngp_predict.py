@@ -0,0 +1,189 @@
+#-*- coding:utf-8 -*-
+# Prediction helpers shared by the scripts that keep DNNGP models in memory instead of going through Pre_dnngp.main.
+# They reproduce what Pre_dnngp does: load the saved Keras model, add the channel axis the Conv1D input expects,
+# run the forward pass and write "ID,Prediction" csv files. Models exported by export_model.py (SavedModel directory
+# or .tflite) are loaded through the same load_model() and can be used wherever an h5 model is accepted.
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+import genotype_store
+
+
+class TFLiteModel:
+    """A .tflite model behind the small part of the Keras model interface the prediction scripts use"""
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.width = int(self.input['shape'][1])
+        self.batch = None
+
+    def __call__(self, x, training=False):
+        x = np.asarray(x, dtype=self.input['dtype'])
+        if self.batch != len(x):
+            self.interpreter.resize_tensor_input(self.input['index'], x.shape, strict=False)
+            self.interpreter.allocate_tensors()
+            self.batch = len(x)
+        self.interpreter.set_tensor(self.input['index'], x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output['index']).copy()
+
+    def predict(self, x, batch_size=1024, verbose=0):
+        return np.concatenate([self(x[start:start + batch_size]) for start in range(0, len(x), batch_size)])
+
+
+class SavedModel:
+    """The serving signature of an exported SavedModel directory"""
+
+    def __init__(self, path):
+        import tensorflow as tf
+        self.function = tf.saved_model.load(path).signatures['serving_default']
+        spec = list(self.function.structured_input_signature[1].values())[0]
+        self.input_name = list(self.function.structured_input_signature[1])[0]
+        self.width = int(spec.shape[1])
+
+    def __call__(self, x, training=False):
+        return list(self.function(**{self.input_name: x}).values())[0].numpy()
+
+    def predict(self, x, batch_size=1024, verbose=0):
+        return np.concatenate([self(x[start:start + batch_size]) for start in range(0, len(x), batch_size)])
+
+
+def load_model(path):
+    """Load a model for inference only: training.model.h5, a .tflite file or a SavedModel directory
+    written by export_model.py"""
+    if str(path).endswith('.tflite'):
+        return TFLiteModel(path)
+    if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'keras_metadata.pb')):
+        return SavedModel(path)
+    import tensorflow as tf
+    # compile=False: the loss (ccc_loss in some models) and optimizer state are not needed to predict
+    return tf.keras.models.load_model(path, compile=False)
+
+
+def input_width(model):
+    """Number of markers the model expects"""
+    if hasattr(model, 'width'):
+        return model.width
+    return int(model.inputs[0].shape[1])
+
+
+def read_genotype(path):
+    """Genotype DataFrame from a .pkl file or a memory-mapped genotype store (.npy)"""
+    if genotype_store.is_store(path):
+        return genotype_store.load(path)
+    return pd.read_pickle(path)
+
+
+def predict_array(model, values, batch_size=None):
+    """Predictions for a samples x markers array; one value per sample for single-trait models"""
+    x = np.expand_dims(np.asarray(values, dtype=np.float32), 2)
+    if batch_size is None or len(x) <= batch_size:
+        # a direct call avoids the per-call setup of model.predict, which dominates for small batches
+        y = model(x, training=False)
+        y = y.numpy() if hasattr(y, 'numpy') else np.asarray(y)
+    else:
+        y = model.predict(x, batch_size=batch_size, verbose=0)
+    return y[:, 0] if y.ndim == 2 and y.shape[1] == 1 else y
+
+
+def write_predictions(path, ids, predictions, columns=('Prediction',)):
+    """Write predictions in the layout of Prediction.ALL.csv"""
+    predictions = np.asarray(predictions)
+    if predictions.ndim == 1:
+        predictions = predictions[:, None]
+    frame = pd.DataFrame(predictions, index=pd.Index(ids, name='ID'), columns=list(columns))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    frame.to_csv(path)
+    return path
+
+
+def iter_genotype_chunks(path, chunk_size):
+    """(sample IDs, float32 samples x markers array) for consecutive chunks of rows
+
+    Genotype stores (.npy) and text files (.tsv/.csv/.txt) are read chunk by chunk, so memory does not grow with
+    the number of samples; a pickled DataFrame has to be loaded whole and is only sliced.
+    """
+    if genotype_store.is_store(path):
+        matrix, samples, _ = genotype_store.load_array(path)
+        for start in range(0, len(samples), chunk_size):
+            yield samples[start:start + chunk_size], np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+    elif path.endswith(('.tsv', '.csv', '.txt')):
+        sep = ',' if path.endswith('.csv') else '\t'
+        for chunk in pd.read_csv(path, sep=sep, index_col=0, chunksize=chunk_size):
+            yield list(chunk.index), chunk.to_numpy(dtype=np.float32)
+    else:
+        genotype = pd.read_pickle(path)
+        for start in range(0, len(genotype), chunk_size):
+            chunk = genotype.iloc[start:start + chunk_size]
+            yield list(chunk.index), chunk.to_numpy(dtype=np.float32)
+
+
+def prefetch(iterable, depth=1):
+    """Iterate in a background thread, keeping up to depth items ready, so reading overlaps with computing"""
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+        items.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def count_samples(path):
+    """Number of samples of a genotype file, without loading the matrix where possible"""
+    if genotype_store.is_store(path):
+        return genotype_store.load_array(path)[0].shape[0]
+    if path.endswith(('.tsv', '.csv', '.txt')):
+        with open(path, 'rb') as f:
+            return sum(1 for line in f if line.strip()) - 1
+    return len(pd.read_pickle(path))
+
+
+def predict_stream(model, snp_file, output_file, chunk_size=10000, batch_size=1024):
+    """Predict a genotype file chunk by chunk and append the results as they are computed
+
+    output_file ending in .npy is written as a float32 array with the IDs in <name>.samples.txt
+    (the genotype store layout), anything else as an "ID,Prediction" csv.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    binary = genotype_store.is_store(output_file)
+    if binary:
+        values = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32, shape=(count_samples(snp_file),))
+        ids = open(genotype_store.sidecar_paths(output_file)[0], 'w')
+    else:
+        ids = open(output_file, 'w')
+        ids.write('ID,Prediction\n')
+    done = 0
+    try:
+        for samples, chunk in prefetch(iter_genotype_chunks(snp_file, chunk_size)):
+            predictions = predict_array(model, chunk, batch_size)
+            if binary:
+                values[done:done + len(samples)] = predictions
+                ids.writelines(f"{name}\n" for name in samples)
+            else:
+                pd.DataFrame({'ID': samples, 'Prediction': predictions}).to_csv(ids, header=False, index=False)
+            done += len(samples)
+            print(f"{done} samples predicted")
+    finally:
+        ids.close()
+        if binary:
+            values.flush()
+            del values
+    return done
@@ -0,0 +1,196 @@
+#-*- coding:utf-8 -*-
+# Opt-in phase profiling for the DNNGP runners (--profile profile.json, --trace <dir>, --trace_steps 10,20).
+# Import this module before TensorFlow: the time from there to Profiler() is recorded as the "import" phase.
+# Phases record wall time, CPU time, resident and peak memory; the compiled dnngp/Pre_dnngp modules are timed by
+# wrapping the functions they call (readData, dnngp_model, load_model, pandas I/O, Keras fit/predict/save; the same
+# for dnngp_train's read_data/build_model),
+# and every training epoch is recorded through a Keras callback added to fit().
+import os
+import sys
+import time
+import json
+import inspect
+import argparse
+import functools
+import contextlib
+
+IMPORT_TIME = (time.time(), time.process_time())
+import dnngp_results
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB (Linux only, None elsewhere)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def fit_arguments(fit, model, *args, **kwargs):
+    """Bind a Model.fit call to fit's signature and return its arguments by name, without the model
+
+    callbacks/initial_epoch may be passed positionally; the wrappers around fit add to them by name and call
+    fit(model, **arguments), so nothing reaches fit twice.
+    """
+    bound = inspect.signature(fit).bind(model, *args, **kwargs)
+    arguments = dict(bound.arguments)
+    arguments.pop(next(iter(arguments)))
+    for name, parameter in inspect.signature(fit).parameters.items():
+        if parameter.kind is inspect.Parameter.VAR_KEYWORD:
+            arguments.update(arguments.pop(name, {}))
+        elif parameter.kind is inspect.Parameter.VAR_POSITIONAL and arguments.get(name):
+            raise TypeError(f"{fit.__qualname__}() got unexpected extra positional arguments")
+    return arguments
+
+
+def add_options(parser):
+    parser.add_argument('--profile', default=None, help='write wall/CPU time and memory per phase and epoch to this JSON file')
+    parser.add_argument('--trace', default=None, help='write a TensorFlow profiler trace to this directory')
+    parser.add_argument('--trace_steps', default=None,
+                        help='first,last training step to trace (e.g. 10,20), default=the whole run')
+
+
+def from_argv():
+    """Take the profiling options off sys.argv (before config_dnngp parses it) and return a Profiler"""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_options(parser)
+    opt, sys.argv[1:] = parser.parse_known_args()
+    return Profiler(opt.profile, opt.trace, opt.trace_steps)
+
+
+class Profiler:
+    """Records phases; every method is a no-op unless a profile file or trace directory was given"""
+
+    def __init__(self, path=None, trace_dir=None, trace_steps=None):
+        self.path = path
+        self.trace_dir = trace_dir
+        self.trace_steps = tuple(int(s) for s in trace_steps.split(',')) if trace_steps else None
+        self.enabled = bool(path or trace_dir)
+        self.start = IMPORT_TIME
+        self.phases = []
+        self.epochs = []
+        self.depth = 0
+        self.tracing = False
+        if self.enabled:
+            self.record('import', IMPORT_TIME, (time.time(), time.process_time()))
+
+    def record(self, name, start, end, **extra):
+        self.phases.append(dict({
+            'name': name, 'depth': self.depth, 'start': start[0] - self.start[0], 'wall_seconds': end[0] - start[0],
+            'cpu_seconds': end[1] - start[1], 'rss_mb': current_rss_mb(), 'peak_rss_mb': dnngp_results.peak_rss_mb(),
+        }, **extra))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = (time.time(), time.process_time())
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.record(name, start, (time.time(), time.process_time()))
+
+    def wrap(self, owner, attribute, name=None):
+        """Time every call of owner.attribute as a phase (skipped if the attribute does not exist)"""
+        function = getattr(owner, attribute, None)
+        if not self.enabled or function is None or getattr(function, 'profiled', False):
+            return
+
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            with self.phase(name or attribute):
+                return function(*args, **kwargs)
+
+        profiled.profiled = True
+        setattr(owner, attribute, profiled)
+
+    def instrument(self, *modules):
+        """Wrap the data loading, model and I/O functions used by the compiled DNNGP modules and Keras"""
+        if not self.enabled:
+            return
+        import pandas as pd
+        import tensorflow as tf
+        for module in modules:
+            for attribute in ('readData', 'read_data', 'dnngp_model', 'build_model', 'load_model'):
+                self.wrap(module, attribute)
+        self.wrap(pd, 'read_pickle')
+        self.wrap(pd, 'read_csv')
+        self.wrap(pd.DataFrame, 'to_csv', 'write_csv')
+        self.wrap(tf.keras.Model, 'compile')
+        self.wrap(tf.keras.Model, 'predict')
+        self.wrap(tf.keras.Model, 'save')
+        profiler = self
+        fit = tf.keras.Model.fit
+
+        @functools.wraps(fit)
+        def profiled_fit(model, *args, **kwargs):
+            kwargs = fit_arguments(fit, model, *args, **kwargs)
+            kwargs['callbacks'] = list(kwargs.get('callbacks') or []) + profiler.callbacks()
+            with profiler.phase('fit'):
+                return fit(model, **kwargs)
+
+        tf.keras.Model.fit = profiled_fit
+        if self.trace_dir and not self.trace_steps:
+            tf.profiler.experimental.start(self.trace_dir)
+            self.tracing = True
+
+    def callbacks(self):
+        """Per-epoch timing, plus the profiler trace over --trace_steps"""
+        import tensorflow as tf
+        profiler = self
+
+        class EpochTimer(tf.keras.callbacks.Callback):
+            def on_epoch_begin(self, epoch, logs=None):
+                self.begin = (time.time(), time.process_time())
+
+            def on_epoch_end(self, epoch, logs=None):
+                end = (time.time(), time.process_time())
+                profiler.epochs.append({
+                    'epoch': epoch + 1, 'wall_seconds': end[0] - self.begin[0], 'cpu_seconds': end[1] - self.begin[1],
+                    'rss_mb': current_rss_mb(), 'peak_rss_mb': dnngp_results.peak_rss_mb(),
+                    'logs': {k: float(v) for k, v in (logs or {}).items()}})
+
+        class StepTrace(tf.keras.callbacks.Callback):
+            step = 0
+
+            def on_train_batch_begin(self, batch, logs=None):
+                if StepTrace.step == profiler.trace_steps[0] and not profiler.tracing:
+                    tf.profiler.experimental.start(profiler.trace_dir)
+                    profiler.tracing = True
+
+            def on_train_batch_end(self, batch, logs=None):
+                if StepTrace.step == profiler.trace_steps[1] and profiler.tracing:
+                    tf.profiler.experimental.stop()
+                    profiler.tracing = False
+                StepTrace.step += 1
+
+        callbacks = [EpochTimer()]
+        if self.trace_dir and self.trace_steps:
+            callbacks.append(StepTrace())
+        return callbacks
+
+    def save(self):
+        """Stop a running trace and write the profile file"""
+        if self.tracing:
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        if not self.path:
+            return
+        totals = {}
+        for phase in self.phases:
+            total = totals.setdefault(phase['name'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            total['calls'] += 1
+            total['wall_seconds'] += phase['wall_seconds']
+            total['cpu_seconds'] += phase['cpu_seconds']
+        profile = {'argv': sys.argv, 'wall_seconds': time.time() - self.start[0],
+                   'cpu_seconds': time.process_time() - self.start[1], 'peak_rss_mb': dnngp_results.peak_rss_mb(),
+                   'totals': totals, 'phases': self.phases, 'epochs': self.epochs}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        print(f"Profile save in: {self.path}")
@@ -0,0 +1,147 @@
+#-*- coding:utf-8 -*-
+# Machine-readable result records for DNNGP training.
+# dnngp.main only reports its results as text, so run_main() captures that text once, reads the model history
+# it saved, and turns both into one JSON record per fold that the tuning and reporting scripts can consume directly.
+import io
+import os
+import re
+import sys
+import json
+import time
+import contextlib
+import pandas as pd
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RESULT_FILE = 'dnngp_results.jsonl'
+
+
+class _Tee(io.TextIOBase):
+    """Write to a buffer and, optionally, pass everything through to the real stdout"""
+
+    def __init__(self, stream=None):
+        self.buffer_ = io.StringIO()
+        self.stream = stream
+
+    def write(self, text):
+        self.buffer_.write(text)
+        if self.stream is not None:
+            self.stream.write(text)
+        return len(text)
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+    def getvalue(self):
+        return self.buffer_.getvalue()
+
+
+def parse_output(text):
+    """Pick the correlation and the model history path out of the text printed by dnngp.main"""
+    result = {'correlation': None, 'history_file': None}
+    statistic = re.search(r'statistic=([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)', text)
+    if statistic:
+        result['correlation'] = float(statistic.group(1))
+    history = re.search(r'Model history save in:\s*(.+)', text)
+    if history:
+        result['history_file'] = history.group(1).strip()
+    return result
+
+
+def summarize_history(history_file):
+    """Epochs run, best epoch and losses from a Modelhistory csv"""
+    if not history_file or not os.path.exists(history_file):
+        return {}
+    history = pd.read_csv(history_file)
+    if history.empty:
+        return {}
+    epochs = history['epoch'] if 'epoch' in history.columns else pd.Series(range(len(history)))
+    summary = {'epochs_run': int(len(history))}
+    if 'loss' in history.columns:
+        summary['loss'] = float(history['loss'].iloc[-1])
+    if 'val_loss' in history.columns:
+        best = history['val_loss'].idxmin()
+        summary['best_epoch'] = int(epochs.loc[best])
+        summary['val_loss'] = float(history['val_loss'].loc[best])
+    return summary
+
+
+def run_main(dnngp, SNP, pheno, batch_size, lr, epoch, patience, dropout1, dropout2, output, SEED, CV, part,
+             NMearlystopping, echo=True):
+    """Run dnngp.main for one fold and return (record, captured stdout)"""
+    tee = _Tee(sys.stdout if echo else None)
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    with contextlib.redirect_stdout(tee):
+        dnngp.main(SNP, pheno, batch_size, lr, epoch, patience, dropout1, dropout2, output, SEED, CV, part,
+                   NMearlystopping)
+    text = tee.getvalue()
+    parsed = parse_output(text)
+    record = {
+        'snp': SNP,
+        'pheno': pheno,
+        'params': {'batch_size': batch_size, 'lr': lr, 'epoch': epoch, 'patience': patience, 'dropout1': dropout1,
+                   'dropout2': dropout2, 'seed': SEED, 'earlystopping': NMearlystopping},
+        'cv': CV,
+        'fold': part,
+        'correlation': parsed['correlation'],
+        'history_file': parsed['history_file'],
+        'start_time': start_wall,
+        'wall_seconds': time.time() - start_wall,
+        'cpu_seconds': time.process_time() - start_cpu,
+    }
+    record.update(summarize_history(parsed['history_file']))
+    return record, text
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (None where the platform does not report it)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def append_record(path, record):
+    """Append one record as a JSON line; a single write keeps lines from concurrent processes intact"""
+    line = json.dumps(record) + '\n'
+    with open(path, 'a') as f:
+        f.write(line)
+
+
+def read_records(path):
+    """All records of a JSON-lines result file, skipping a partially written last line"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def parse_parts(value, cv):
+    """Folds selected by --part: "all", a comma separated list such as "1,3,5", or a single fold"""
+    if str(value).strip().lower() == 'all':
+        return list(range(1, cv + 1))
+    parts = [int(p) for p in str(value).split(',') if p.strip()]
+    bad = [p for p in parts if not 1 <= p <= cv]
+    if bad or not parts:
+        raise ValueError(f"--part must be 'all' or folds between 1 and {cv}, got {value}")
+    return parts
+
+
+def write_cv_summary(path, records):
+    """One row per fold (correlation, epochs, losses, time) plus mean and SD rows over the folds"""
+    columns = ['fold', 'correlation', 'epochs_run', 'best_epoch', 'loss', 'val_loss', 'wall_seconds', 'history_file']
+    table = pd.DataFrame([{c: r.get(c) for c in columns} for r in records], columns=columns).set_index('fold')
+    numeric = table.drop(columns=['history_file']).apply(pd.to_numeric, errors='coerce')
+    summary = pd.concat([table, numeric.mean().to_frame('mean').T, numeric.std().to_frame('sd').T])
+    summary.index.name = 'fold'
+    summary.to_csv(path)
+    return summary
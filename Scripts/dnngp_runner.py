@@ -2,13 +2,30 @@
 
 import time,sys
 import os
+import argparse
 # 获取当前脚本所在目录并添加到路径，以便找到编译的扩展模块
 script_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, script_dir)
+import dnngp_profile  # imported before config_dnngp/dnngp so that their TensorFlow import is timed
 import config_dnngp, dnngp
+import dnngp_results
+import dnngp_checkpoint
+import genotype_store
 
 if __name__ == '__main__': 
     start_model = time.time()
+    # Options that config_dnngp does not know are taken off the command line before it is parsed.
+    profiler = dnngp_profile.from_argv()
+    checkpointer = dnngp_checkpoint.from_argv()  # --checkpoint_every/--resume/--init_from
+    extra = argparse.ArgumentParser(add_help=False)
+    extra.add_argument('--result_json', default=None,
+                       help='JSON-lines file that receives one result record per fold, default=<output>/dnngp_results.jsonl')
+    extra.add_argument('--part', default=None,
+                       help='fold to train, a comma separated list of folds (e.g. 1,3,5) or "all"; several folds are '
+                            'trained in this process, each into <output>/fold<k>/, with a summary in <output>/cv_summary.csv')
+    extra_opt, sys.argv[1:] = extra.parse_known_args()
+    if extra_opt.part is not None:
+        sys.argv[1:] += ['--part', '1']  # placeholder for config_dnngp, the folds are taken from extra_opt.part
     opt = config_dnngp.get_options()
     batch_size = opt.batch_size
     lr = opt.lr
@@ -21,9 +38,36 @@ if __name__ == '__main__':
     output = opt.output
     SEED = opt.seed
     CV = opt.cv
-    part = opt.part
+    parts = dnngp_results.parse_parts(extra_opt.part, CV) if extra_opt.part is not None else [opt.part]
     NMearlystopping = opt.earlystopping
-    dnngp.prepare() 
-    dnngp.main(SNP, pheno, batch_size, lr, epoch, patience, dropout1, dropout2, output, SEED, CV, part, NMearlystopping)
+    # --snp may also be a memory-mapped genotype store (.npy); with several folds the data is read only once
+    genotype_store.install_reader(cache=len(parts) > 1)
+    profiler.instrument(dnngp)
+    checkpointer.install()  # the Model.fit of dnngp.main saves checkpoints into <output>/checkpoint/
+    with profiler.phase('prepare'):
+        dnngp.prepare() 
+    result_json = extra_opt.result_json or os.path.join(output, dnngp_results.RESULT_FILE)
+    if len(parts) == 1:
+        checkpointer.directory = os.path.join(output, 'checkpoint')
+        with profiler.phase('main'):
+            record, _ = dnngp_results.run_main(dnngp, SNP, pheno, batch_size, lr, epoch, patience, dropout1, dropout2, output, SEED, CV, parts[0], NMearlystopping)
+        dnngp_results.append_record(result_json, record)
+    else:
+        import tensorflow as tf
+        records = []
+        for part in parts:
+            # Every fold writes its model, history and validation predictions into its own directory.
+            fold_output = os.path.join(output, f"fold{part}", '')
+            os.makedirs(fold_output, exist_ok=True)
+            checkpointer.directory = os.path.join(fold_output, 'checkpoint')
+            with profiler.phase(f'main fold{part}'):
+                record, _ = dnngp_results.run_main(dnngp, SNP, pheno, batch_size, lr, epoch, patience, dropout1, dropout2, fold_output, SEED, CV, part, NMearlystopping)
+            dnngp_results.append_record(result_json, record)
+            records.append(record)
+            tf.keras.backend.clear_session()  # drop the finished fold's graph
+        summary = dnngp_results.write_cv_summary(os.path.join(output, 'cv_summary.csv'), records)
+        print(f"Corr obs vs pred of {len(parts)} folds: mean = {summary.loc['mean', 'correlation']}, sd = {summary.loc['sd', 'correlation']}")
+        print(f"CV summary save in: {os.path.join(output, 'cv_summary.csv')}")
+    profiler.save()
     end_model = time.time()
     print('Running time: %s Seconds' % (end_model - start_model))
\ No newline at end of file
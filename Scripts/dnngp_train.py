@@ -0,0 +1,279 @@
+#-*- coding:utf-8 -*-
+# Python-source DNNGP trainer with one network for several traits.
+# The compiled dnngp.main predicts one phenotype column per run. Here the Conv1D trunk of dnngp_model (same layers,
+# regularizers and callbacks as the saved training.model.h5) is shared and every phenotype column gets its own
+# Dense(3) -> Dropout -> Dense(1) head, so N traits are trained in one pass over the genotypes instead of N runs.
+# Missing phenotypes (NaN) are masked per sample and trait in the loss and metrics.
+import os
+import time
+import random
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from sklearn.model_selection import KFold
+import dnngp_checkpoint
+import dnngp_predict
+import dnngp_results
+
+LOSSES = ('mse', 'ccc')
+INPUT_PIPELINES = ('numpy', 'tfdata')
+
+
+def compact(genotype, block_rows=1024):
+    """The genotype over an int8 (integer dosages) or float32 matrix, converted block by block
+
+    Memory-mapped stores are already compact and returned unchanged.
+    """
+    values = genotype.to_numpy()
+    if values.dtype in (np.int8, np.float32):
+        return genotype
+    blocks = range(0, len(values), block_rows)
+    dosages = all(np.array_equal(values[i:i + block_rows], np.rint(values[i:i + block_rows])) and
+                  np.abs(values[i:i + block_rows]).max(initial=0) <= 127 for i in blocks)
+    matrix = np.empty(values.shape, dtype=np.int8 if dosages else np.float32)
+    for i in blocks:
+        matrix[i:i + block_rows] = values[i:i + block_rows]
+    return pd.DataFrame(matrix, index=genotype.index, columns=genotype.columns, copy=False)
+
+
+def read_data(snp_file, pheno_file, traits=None, low_memory=False):
+    """Genotype DataFrame and phenotype DataFrame (samples with at least one observed trait, in genotype order)
+
+    The genotype is returned as read (not sliced to the phenotyped samples), so a memory-mapped store is not copied;
+    rows are picked by position when the batches are built. With low_memory the genotype is held as int8/float32.
+    """
+    genotype = dnngp_predict.read_genotype(snp_file)
+    if low_memory:
+        genotype = compact(genotype)
+    pheno = pd.read_csv(pheno_file, sep='\t', index_col=0)
+    if traits:
+        missing = [t for t in traits if t not in pheno.columns]
+        if missing:
+            raise ValueError(f"traits not in {pheno_file}: {missing}")
+        pheno = pheno[list(traits)]
+    pheno = pheno.apply(pd.to_numeric, errors='coerce').dropna(how='all')
+    samples = genotype.index[genotype.index.isin(pheno.index)]
+    if len(samples) == 0:
+        raise ValueError(f"{snp_file} and {pheno_file} have no samples in common")
+    return genotype, pheno.loc[samples].astype(np.float32)
+
+
+def split(n_samples, cv, part, seed):
+    """(train, validation) indices of fold part (1-based), the KFold split of dnngp.main"""
+    folds = list(KFold(n_splits=cv, shuffle=True, random_state=seed).split(np.arange(n_samples)))
+    return folds[part - 1]
+
+
+def _masked(y_true, y_pred):
+    """Observed-value mask, y_true with NaN replaced by 0, and the number of observations per trait"""
+    observed = tf.math.logical_not(tf.math.is_nan(y_true))
+    mask = tf.cast(observed, y_pred.dtype)
+    y_true = tf.where(observed, y_true, tf.zeros_like(y_true))
+    return mask, y_true, tf.maximum(tf.reduce_sum(mask, axis=0), 1.0)
+
+
+def masked_mse(y_true, y_pred):
+    """Mean over traits of each trait's MSE on its observed samples"""
+    mask, y_true, count = _masked(y_true, y_pred)
+    return tf.reduce_mean(tf.reduce_sum(tf.square(y_pred - y_true) * mask, axis=0) / count)
+
+
+def masked_ccc_loss(y_true, y_pred):
+    """1 - mean over traits of the concordance correlation coefficient on the observed samples"""
+    mask, y_true, count = _masked(y_true, y_pred)
+    mean_true = tf.reduce_sum(y_true * mask, axis=0) / count
+    mean_pred = tf.reduce_sum(y_pred * mask, axis=0) / count
+    var_true = tf.reduce_sum(tf.square(y_true - mean_true) * mask, axis=0) / count
+    var_pred = tf.reduce_sum(tf.square(y_pred - mean_pred) * mask, axis=0) / count
+    cov = tf.reduce_sum((y_true - mean_true) * (y_pred - mean_pred) * mask, axis=0) / count
+    ccc = 2 * cov / (var_true + var_pred + tf.square(mean_true - mean_pred) + tf.keras.backend.epsilon())
+    return 1 - tf.reduce_mean(ccc)
+
+
+def trait_metrics(traits):
+    """Masked MSE and MAE of every trait, reported per epoch as mse_<trait>/mae_<trait>"""
+    metrics = []
+    for i, trait in enumerate(traits):
+        name = ''.join(c if c.isalnum() else '_' for c in str(trait))
+
+        def mse(y_true, y_pred, i=i):
+            return masked_mse(y_true[:, i:i + 1], y_pred[:, i:i + 1])
+
+        def mae(y_true, y_pred, i=i):
+            mask, y, count = _masked(y_true[:, i:i + 1], y_pred[:, i:i + 1])
+            return tf.reduce_sum(tf.abs(y_pred[:, i:i + 1] - y) * mask) / count[0]
+
+        mse.__name__, mae.__name__ = f"mse_{name}", f"mae_{name}"
+        metrics += [mse, mae]
+    return metrics
+
+
+def build_model(n_markers, traits, dropout1, dropout2):
+    """The DNNGP network with one output head per trait; the output is (batch, traits)"""
+    init = tf.keras.initializers.TruncatedNormal(mean=0.0, stddev=0.05)
+    l2 = tf.keras.regularizers.l2
+    inputs = tf.keras.Input(shape=(n_markers, 1), name='genotype')
+    x = tf.keras.layers.Conv1D(64, 4, padding='same', activation='relu', kernel_initializer=init,
+                               kernel_regularizer=l2(0.01), bias_regularizer=l2(0.1))(inputs)
+    x = tf.keras.layers.Dropout(dropout1)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Conv1D(64, 4, padding='same', activation='relu', kernel_initializer=init,
+                               kernel_regularizer=l2(0.001), bias_regularizer=l2(1e-5))(x)
+    x = tf.keras.layers.Dropout(dropout2)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Conv1D(64, 4, padding='same', activation='relu', kernel_initializer=init,
+                               kernel_regularizer=l2(0.001), bias_regularizer=l2(1e-4))(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Flatten()(x)
+    heads = []
+    for trait in traits:
+        name = ''.join(c if c.isalnum() else '_' for c in str(trait))
+        h = tf.keras.layers.Dense(3, activation='linear', name=f"{name}_dense")(x)
+        h = tf.keras.layers.Dropout(dropout2, name=f"{name}_dropout")(h)
+        heads.append(tf.keras.layers.Dense(1, activation='linear', name=name)(h))
+    outputs = heads[0] if len(heads) == 1 else tf.keras.layers.Concatenate(name='traits')(heads)
+    return tf.keras.Model(inputs, outputs, name='dnngp_multi_trait')
+
+
+def evaluate(y_true, y_pred, traits):
+    """Per-trait correlation, MSE and MAE on the observed validation samples"""
+    rows = []
+    for i, trait in enumerate(traits):
+        observed = ~np.isnan(y_true[:, i])
+        t, p = y_true[observed, i], y_pred[observed, i]
+        corr = float(np.corrcoef(t, p)[0, 1]) if len(t) > 1 and t.std() > 0 and p.std() > 0 else float('nan')
+        rows.append({'trait': trait, 'n': int(observed.sum()), 'correlation': corr,
+                     'mse': float(np.mean((p - t) ** 2)) if len(t) else float('nan'),
+                     'mae': float(np.mean(np.abs(p - t))) if len(t) else float('nan')})
+    return pd.DataFrame(rows).set_index('trait')
+
+
+def make_dataset(x, y, rows, batch_size, shuffle=False, seed=None, cache=False):
+    """tf.data pipeline over the rows of x without copying x: shuffled row indices are batched and each batch is
+    gathered (and converted to float32) in parallel map calls, overlapping with training through prefetch
+
+    cache=True keeps the converted samples in memory after the first epoch (shuffled again every epoch).
+    """
+    n_markers, n_traits = x.shape[1], y.shape[1]
+
+    def gather(index):
+        index = np.sort(index)  # ascending rows read a memory map sequentially; the order within a batch is irrelevant
+        return np.expand_dims(np.asarray(x[index], dtype=np.float32), 2), y[index]
+
+    def load(index):
+        xb, yb = tf.numpy_function(gather, [index], [tf.float32, tf.float32])
+        return tf.ensure_shape(xb, [None, n_markers, 1]), tf.ensure_shape(yb, [None, n_traits])
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(rows, dtype=np.int64))
+    if cache:
+        dataset = dataset.batch(max(batch_size, 256)).map(load, num_parallel_calls=tf.data.AUTOTUNE).unbatch().cache()
+        if shuffle:
+            dataset = dataset.shuffle(len(rows), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+    else:
+        if shuffle:
+            dataset = dataset.shuffle(len(rows), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size).map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def prepare():
+    """Let TensorFlow allocate GPU memory as needed, as dnngp.prepare() does"""
+    for gpu in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+
+def set_seed(seed):
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+
+def train(snp_file, pheno_file, batch_size, lr, epoch, patience, dropout1, dropout2, output, seed, cv, part,
+          earlystopping, traits=None, loss='mse', data=None, input_pipeline='numpy', cache=False, low_memory=False,
+          checkpoint_every=None, resume=False, init_from=None):
+    """Train one fold on all selected traits; writes the files of dnngp.main and returns a result record
+
+    data: (genotype, phenotype) from read_data(), so several folds can share one read.
+    input_pipeline: 'numpy' copies the fold into float32 arrays passed to fit(), 'tfdata' streams batches through
+    make_dataset() (cache: keep the converted training samples in memory).
+    low_memory: keep the genotype as int8/float32 and convert every mini-batch on the fly (tfdata without cache),
+    so no float32 copy of a fold is ever made.
+    checkpoint_every/resume: save a checkpoint every N epochs into <output>/checkpoint/ and continue from it;
+    init_from: warm start from a trained model of the same architecture (see dnngp_checkpoint).
+    """
+    if loss not in LOSSES:
+        raise ValueError(f"loss must be one of {LOSSES}, got {loss}")
+    if input_pipeline not in INPUT_PIPELINES:
+        raise ValueError(f"input_pipeline must be one of {INPUT_PIPELINES}, got {input_pipeline}")
+    if low_memory:
+        input_pipeline, cache = 'tfdata', False
+    start_wall, start_cpu = time.time(), time.process_time()
+    genotype, pheno = data if data is not None else read_data(snp_file, pheno_file, traits, low_memory)
+    traits = list(pheno.columns)
+    x = genotype.to_numpy()
+    y = np.full((len(x), pheno.shape[1]), np.nan, dtype=np.float32)
+    rows = genotype.index.get_indexer(pheno.index)  # genotype row of every phenotyped sample
+    y[rows] = pheno.to_numpy(dtype=np.float32)
+    train_idx, val_idx = split(len(rows), cv, part, seed)
+    train_rows, val_rows = rows[train_idx], rows[val_idx]
+    set_seed(seed)
+
+    model = build_model(x.shape[1], traits, dropout1, dropout2)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
+                  loss=masked_mse if loss == 'mse' else masked_ccc_loss, metrics=trait_metrics(traits))
+    checkpointer = dnngp_checkpoint.Checkpointer(checkpoint_every, resume, init_from, os.path.join(output, 'checkpoint'))
+    callbacks = [tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss', patience=patience),
+                 tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=earlystopping,
+                                                  restore_best_weights=True)]
+    if input_pipeline == 'tfdata':
+        train_data = make_dataset(x, y, train_rows, batch_size, shuffle=True, seed=seed, cache=cache)
+        x_val = make_dataset(x, y, val_rows, batch_size, cache=not low_memory)
+        history = checkpointer.fit(model, train_data, epochs=epoch, verbose=2, validation_data=x_val,
+                                   callbacks=callbacks)
+    else:
+        x_train = np.expand_dims(np.asarray(x[train_rows], dtype=np.float32), 2)
+        x_val = np.expand_dims(np.asarray(x[val_rows], dtype=np.float32), 2)
+        history = checkpointer.fit(model, x_train, y[train_rows], batch_size=batch_size, epochs=epoch, verbose=2,
+                                   validation_data=(x_val, y[val_rows]), callbacks=callbacks)
+
+    os.makedirs(output, exist_ok=True)
+    model_file = os.path.join(output, 'training.model.h5')
+    model.save(model_file, include_optimizer=False)
+    history_file = os.path.join(output, 'Modelhistory.csv')
+    frame = pd.DataFrame(history.history)
+    frame.insert(0, 'epoch', np.arange(1, len(frame) + 1))
+    frame.to_csv(history_file, index=False)
+
+    predict_batch = {} if input_pipeline == 'tfdata' else {'batch_size': batch_size}  # a dataset is already batched
+    predictions = model.predict(x_val, **predict_batch).reshape(len(val_idx), len(traits))
+    dnngp_predict.write_predictions(os.path.join(output, 'Prediction.validation.csv'), pheno.index[val_idx],
+                                    predictions, traits)
+    metrics = evaluate(y[val_rows], predictions, traits)
+    metrics.to_csv(os.path.join(output, 'trait_metrics.csv'))
+    for trait, row in metrics.iterrows():
+        print(f"{trait}: Corr obs vs pred = {row['correlation']}")
+    print(f"Model history save in: {history_file}")
+    print(f"Peak RSS: {dnngp_results.peak_rss_mb()} MB")
+
+    record = {
+        'snp': snp_file,
+        'pheno': pheno_file,
+        'params': {'batch_size': batch_size, 'lr': lr, 'epoch': epoch, 'patience': patience, 'dropout1': dropout1,
+                   'dropout2': dropout2, 'seed': seed, 'earlystopping': earlystopping, 'loss': loss,
+                   'input_pipeline': input_pipeline, 'low_memory': low_memory, 'init_from': init_from},
+        'cv': cv,
+        'fold': part,
+        'traits': traits,
+        'correlation': float(metrics['correlation'].mean()),
+        'correlations': {str(t): c for t, c in metrics['correlation'].items()},
+        'history_file': history_file,
+        'model_file': model_file,
+        'start_time': start_wall,
+        'wall_seconds': time.time() - start_wall,
+        'cpu_seconds': time.process_time() - start_cpu,
+        'peak_rss_mb': dnngp_results.peak_rss_mb(),
+    }
+    record.update(dnngp_results.summarize_history(history_file))
+    return record
@@ -0,0 +1,83 @@
+#-*- coding:utf-8 -*-
+# Multi-trait training with the Python-source trainer (dnngp_train.py): every column of the --pheno file
+# (or the ones given with --traits) is trained in one network with a shared trunk and one head per trait.
+# The options are those of dnngp_runner.py; --part also accepts a fold list or "all".
+#
+#   python dnngp_train_runner.py --batch_size 28 --lr 0.001 --epoch 1000 --patience 5 --dropout1 0.5 --dropout2 0.3 \
+#       --seed 123 --cv 5 --part all --earlystopping 10 --snp ../Input_files/wheat599_pc95.pkl \
+#       --pheno ../Input_files/wheat1.tsv --output ../Output_files/multi/
+import os
+import sys
+import time
+import argparse
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+import dnngp_profile  # imported before TensorFlow so that its import is timed
+import dnngp_results
+import dnngp_checkpoint
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='DNNGP multi-trait training')
+    parser.add_argument('--batch_size', type=int, required=True)
+    parser.add_argument('--lr', type=float, required=True)
+    parser.add_argument('--epoch', type=int, required=True)
+    parser.add_argument('--patience', type=int, required=True, help='patience of ReduceLROnPlateau')
+    parser.add_argument('--dropout1', type=float, required=True)
+    parser.add_argument('--dropout2', type=float, required=True)
+    parser.add_argument('--snp', required=True, help='genotype file (.pkl or .npy genotype store)')
+    parser.add_argument('--pheno', required=True, help='phenotype tsv, one column per trait')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--cv', type=int, default=10)
+    parser.add_argument('--part', default='1', help='fold, comma separated folds or "all", default=1')
+    parser.add_argument('--earlystopping', type=int, required=True, help='patience of EarlyStopping')
+    parser.add_argument('--traits', default=None, help='comma separated phenotype columns, default=all columns')
+    parser.add_argument('--loss', choices=['mse', 'ccc'], default='mse', help='per-trait loss, default=mse')
+    parser.add_argument('--input_pipeline', choices=['numpy', 'tfdata'], default='numpy',
+                        help='numpy: fold copied into arrays for fit(); tfdata: batches gathered and prefetched by a '
+                             'tf.data pipeline, default=numpy')
+    parser.add_argument('--cache', action='store_true', help='tfdata: keep the converted training samples in memory')
+    parser.add_argument('--low_memory', action='store_true',
+                        help='keep the genotype as int8/float32 (use a .npy genotype store to avoid reading a pickle '
+                             'at all) and convert each mini-batch on the fly; implies --input_pipeline tfdata')
+    dnngp_checkpoint.add_options(parser)
+    dnngp_profile.add_options(parser)
+    parser.add_argument('--result_json', default=None,
+                        help='JSON-lines file that receives one result record per fold, default=<output>/dnngp_results.jsonl')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    start_model = time.time()
+    opt = get_options()
+    import dnngp_train
+    profiler = dnngp_profile.Profiler(opt.profile, opt.trace, opt.trace_steps)
+    profiler.instrument(dnngp_train)
+    with profiler.phase('prepare'):
+        dnngp_train.prepare()
+    parts = dnngp_results.parse_parts(opt.part, opt.cv)
+    traits = opt.traits.split(',') if opt.traits else None
+    data = dnngp_train.read_data(opt.snp, opt.pheno, traits, opt.low_memory)  # read once for all folds
+    print(f"{len(data[1])} samples, {data[0].shape[1]} markers ({data[0].to_numpy().dtype}), traits: {list(data[1].columns)}")
+    result_json = opt.result_json or os.path.join(opt.output, dnngp_results.RESULT_FILE)
+    records = []
+    for part in parts:
+        output = opt.output if len(parts) == 1 else os.path.join(opt.output, f"fold{part}", '')
+        with profiler.phase(f'train fold{part}'):
+            record = dnngp_train.train(opt.snp, opt.pheno, opt.batch_size, opt.lr, opt.epoch, opt.patience, opt.dropout1,
+                                       opt.dropout2, output, opt.seed, opt.cv, part, opt.earlystopping, traits,
+                                       opt.loss, data=data, input_pipeline=opt.input_pipeline, cache=opt.cache,
+                                       low_memory=opt.low_memory, checkpoint_every=opt.checkpoint_every,
+                                       resume=opt.resume, init_from=opt.init_from)
+        os.makedirs(os.path.dirname(os.path.abspath(result_json)), exist_ok=True)
+        dnngp_results.append_record(result_json, record)
+        records.append(record)
+        dnngp_train.tf.keras.backend.clear_session()
+    if len(parts) > 1:
+        summary = dnngp_results.write_cv_summary(os.path.join(opt.output, 'cv_summary.csv'), records)
+        print(f"CV summary save in: {os.path.join(opt.output, 'cv_summary.csv')}")
+    print(f"Peak RSS: {dnngp_results.peak_rss_mb()} MB")
+    profiler.save()
+    end_model = time.time()
+    print('Running time: %s Seconds' % (end_model - start_model))
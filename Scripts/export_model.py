@@ -0,0 +1,138 @@
+#-*- coding:utf-8 -*-
+# Export a trained DNNGP model (training.model.h5) to a lean inference format for CPU-only prediction nodes:
+#   savedmodel  a SavedModel directory holding only the inference graph (no optimizer, loss or training state)
+#   tflite      a TFLite flatbuffer, optionally quantized to float16 weights or int8 (calibrated on --SNP rows)
+# The exported model is accepted by Pre_runner.py --chunk_size, Pre_batch_runner.py and Pre_server.py in place of the h5.
+# With --benchmark the exported model is compared against the h5 on the --SNP samples (prediction difference,
+# latency per sample, file size).
+#
+#   python export_model.py --Model ../Output_files/training.model.h5 --output ../Output_files/model.int8.tflite \
+#       --format tflite --quantize int8 --SNP ../Input_files/wheat599_pc95.pkl --benchmark
+import os
+import sys
+import time
+import argparse
+import numpy as np
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+import dnngp_predict
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='Export a DNNGP model for inference')
+    parser.add_argument('--Model', required=True, help='trained model (training.model.h5)')
+    parser.add_argument('--output', required=True, help='SavedModel directory or .tflite file to write')
+    parser.add_argument('--format', choices=['savedmodel', 'tflite'], default=None,
+                        help='default: tflite if --output ends with .tflite, otherwise savedmodel')
+    parser.add_argument('--quantize', choices=['none', 'float16', 'int8'], default='none',
+                        help='TFLite weight quantization, int8 needs --SNP for calibration, default=none')
+    parser.add_argument('--SNP', default=None, help='genotype file (.pkl/.npy/.tsv) for int8 calibration and --benchmark')
+    parser.add_argument('--calibration_samples', type=int, default=200, help='rows used to calibrate int8, default=200')
+    parser.add_argument('--benchmark', action='store_true', help='compare the exported model with the h5 model on --SNP')
+    parser.add_argument('--benchmark_samples', type=int, default=1000, help='rows used by --benchmark, default=1000')
+    return parser.parse_args()
+
+
+def first_rows(snp_file, n):
+    """The first n rows of a genotype file as float32"""
+    ids, values = [], []
+    for chunk_ids, chunk in dnngp_predict.iter_genotype_chunks(snp_file, n):
+        ids.extend(chunk_ids)
+        values.append(chunk)
+        break
+    return ids, np.concatenate(values)[:n]
+
+
+def export_savedmodel(model, output):
+    """SavedModel with a single serving signature over (batch, markers, 1) float32 input"""
+    import tensorflow as tf
+    spec = tf.TensorSpec([None, dnngp_predict.input_width(model), 1], tf.float32, name='genotype')
+
+    @tf.function(input_signature=[spec])
+    def serve(genotype):
+        return {'prediction': model(genotype, training=False)}
+
+    tf.saved_model.save(model, output, signatures=serve.get_concrete_function())
+
+
+def export_tflite(model, output, quantize='none', calibration=None):
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        if calibration is None:
+            raise ValueError("int8 quantization needs calibration rows, give --SNP")
+
+        def representative_dataset():
+            for row in calibration:
+                yield [row[None, :, None].astype(np.float32)]
+
+        # integer weights and activations; float32 input/output so callers pass genotypes unchanged
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(output, 'wb') as f:
+        f.write(converter.convert())
+
+
+def model_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, name)) for d, _, files in os.walk(path) for name in files)
+    return os.path.getsize(path)
+
+
+def latency(model, values, batch_size, repeats=3):
+    """Best wall time per sample over a few repeats"""
+    dnngp_predict.predict_array(model, values[:batch_size], batch_size)  # warm-up
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for begin in range(0, len(values), batch_size):
+            dnngp_predict.predict_array(model, values[begin:begin + batch_size], batch_size)
+        best = min(best, (time.perf_counter() - start) / len(values))
+    return best
+
+
+def benchmark(reference_path, exported_path, values):
+    """Prediction difference and latency of the exported model against the reference model"""
+    reference = dnngp_predict.load_model(reference_path)
+    exported = dnngp_predict.load_model(exported_path)
+    expected = dnngp_predict.predict_array(reference, values, 1024)
+    actual = dnngp_predict.predict_array(exported, values, 1024)
+    diff = np.abs(actual - expected)
+    report = {
+        'samples': len(values),
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'correlation': float(np.corrcoef(actual, expected)[0, 1]) if len(values) > 1 else None,
+        'size_bytes': {'reference': model_size(reference_path), 'exported': model_size(exported_path)},
+    }
+    for batch_size in (1, 256):
+        report[f'seconds_per_sample_batch{batch_size}'] = {
+            'reference': latency(reference, values[:max(batch_size * 4, 64)], batch_size),
+            'exported': latency(exported, values[:max(batch_size * 4, 64)], batch_size),
+        }
+    return report
+
+
+if __name__ == '__main__':
+    opt = get_options()
+    fmt = opt.format or ('tflite' if opt.output.endswith('.tflite') else 'savedmodel')
+    if fmt == 'savedmodel' and opt.quantize != 'none':
+        raise ValueError("--quantize applies to --format tflite only")
+    if (opt.benchmark or opt.quantize == 'int8') and not opt.SNP:
+        raise ValueError("--SNP is required for --benchmark and int8 quantization")
+    model = dnngp_predict.load_model(opt.Model)
+    start = time.time()
+    if fmt == 'savedmodel':
+        export_savedmodel(model, opt.output)
+    else:
+        calibration = first_rows(opt.SNP, opt.calibration_samples)[1] if opt.quantize == 'int8' else None
+        export_tflite(model, opt.output, opt.quantize, calibration)
+    print(f"Model export in: {opt.output} ({fmt}, quantize={opt.quantize}, {time.time() - start:.1f} Seconds)")
+    if opt.benchmark:
+        _, values = first_rows(opt.SNP, opt.benchmark_samples)
+        for key, value in benchmark(opt.Model, opt.output, values).items():
+            print(f"{key}: {value}")
@@ -0,0 +1,131 @@
+#-*- coding:utf-8 -*-
+# Compact memory-mapped genotype store, an alternative to the pickled float64 DataFrame.
+# A store named "genotype.npy" consists of
+#   genotype.npy          contiguous samples x markers matrix (float32, or int8 for 0/1/2 dosages)
+#   genotype.samples.txt  one sample ID per line
+#   genotype.markers.txt  one marker ID per line
+# The matrix is opened with mmap, so parallel processes share one page-cached copy instead of private copies.
+import os
+import numpy as np
+import pandas as pd
+
+DTYPES = ('float32', 'int8')
+
+
+def is_store(path):
+    return str(path).endswith('.npy')
+
+
+def sidecar_paths(path):
+    prefix = str(path)[:-len('.npy')]
+    return prefix + '.samples.txt', prefix + '.markers.txt'
+
+
+def _write_ids(path, ids):
+    with open(path, 'w') as f:
+        for name in ids:
+            f.write(f"{name}\n")
+
+
+def _read_ids(path):
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def save(path, genotype, dtype='float32'):
+    """Write a samples x markers DataFrame as a genotype store"""
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}, got {dtype}")
+    values = genotype.to_numpy()
+    if dtype == 'int8':
+        values = np.rint(values)
+    np.save(path, np.ascontiguousarray(values, dtype=dtype))
+    samples_file, markers_file = sidecar_paths(path)
+    _write_ids(samples_file, genotype.index)
+    _write_ids(markers_file, genotype.columns)
+
+
+class Writer:
+    """Fill a genotype store block by block when the full matrix does not fit in memory
+
+    Rows are added with append(); when the sample IDs are known up front (e.g. from a VCF header),
+    blocks of markers can be written with write_columns() instead.
+    """
+
+    def __init__(self, path, n_samples, markers, dtype='float32', samples=None):
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}, got {dtype}")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.samples = list(samples) if samples is not None else []
+        self.matrix = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(n_samples, len(markers)))
+        _write_ids(sidecar_paths(path)[1], markers)
+
+    def append(self, samples, values):
+        """Write the next rows (samples x markers)"""
+        start = len(self.samples)
+        if self.dtype.kind == 'i':
+            values = np.rint(values)
+        self.matrix[start:start + len(samples)] = values
+        self.samples.extend(samples)
+
+    def write_columns(self, start, values):
+        """Write the markers start..start+k (values is samples x k)"""
+        if self.dtype.kind == 'i':
+            values = np.rint(values)
+        self.matrix[:, start:start + values.shape[1]] = values
+
+    def close(self):
+        if len(self.samples) != self.matrix.shape[0]:
+            raise ValueError(f"{self.path}: expected {self.matrix.shape[0]} samples, got {len(self.samples)}")
+        self.matrix.flush()
+        del self.matrix
+        _write_ids(sidecar_paths(self.path)[0], self.samples)
+
+
+def load_array(path, mmap=True):
+    """(matrix, sample IDs, marker IDs); the matrix is a read-only memory map unless mmap is False"""
+    matrix = np.load(path, mmap_mode='r' if mmap else None)
+    samples_file, markers_file = sidecar_paths(path)
+    return matrix, _read_ids(samples_file), _read_ids(markers_file)
+
+
+def load(path, mmap=True):
+    """Genotype DataFrame backed by the memory-mapped matrix, without copying it"""
+    matrix, samples, markers = load_array(path, mmap)
+    return pd.DataFrame(matrix, index=pd.Index(samples), columns=pd.Index(markers), copy=False)
+
+
+def install_reader(cache=False):
+    """Let pandas.read_pickle open genotype stores, so the compiled dnngp/Pre_dnngp readData accept --snp genotype.npy
+
+    With cache=True pickles are also kept in memory after the first read, for processes that call dnngp.main
+    several times on the same data (each call gets a copy, so nothing done inside one call leaks into the next).
+    """
+    if not getattr(pd.read_pickle, 'genotype_store', False):
+        read_file = pd.read_pickle
+
+        def read_genotype(path, *args, **kwargs):
+            if is_store(path) and os.path.exists(path):
+                return load(path)
+            return read_file(path, *args, **kwargs)
+
+        read_genotype.genotype_store = True
+        pd.read_pickle = read_genotype
+    read_pickle = pd.read_pickle
+    if not cache or getattr(read_pickle, 'cached', False):
+        return
+    pickles = {}
+
+    def cached_read_pickle(path, *args, **kwargs):
+        if is_store(path):
+            # Memory-mapped stores are already shared through the page cache, a private copy would defeat that.
+            return read_pickle(path, *args, **kwargs)
+        key = os.path.abspath(str(path))
+        if key not in pickles:
+            pickles[key] = read_pickle(path, *args, **kwargs)
+        return pickles[key].copy()
+
+    cached_read_pickle.genotype_store = True
+    cached_read_pickle.cached = True
+    pd.read_pickle = cached_read_pickle
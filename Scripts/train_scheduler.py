@@ -0,0 +1,187 @@
+#-*- coding:utf-8 -*-
+# Resumable scheduler for batches of dnngp_runner.py trainings (traits x hyperparameter sets x folds).
+# Jobs come from a JSON manifest and run N at a time within a CPU budget: every job gets its own share of the
+# cores (OMP/MKL/TF thread variables, optionally pinned with taskset on Linux), its own output
+# directory and a log file that is written while it runs. Failed jobs are retried; every finished attempt is
+# appended to <output>/scheduler_state.jsonl, so a rerun skips the jobs that already succeeded with the same arguments.
+#
+#   python train_scheduler.py train_manifest.example.json --jobs 4 --cpus 16 --pin
+#
+# Manifest:
+#   {"snp": "../Input_files/wheat599_pc95.pkl",
+#    "traits": ["../Input_files/wheat1.tsv"],              pheno files, one training per trait
+#    "output": "../Output_files/batch",                    jobs write to <output>/<trait>/<params name>/fold<k>
+#    "cv": 5, "folds": "all" or [1, 2],
+#    "defaults": {"batch_size": 28, "lr": 0.001, ...},     dnngp_runner.py options shared by all jobs
+#    "params": [{"name": "p1", "dropout1": 0.3}, ...]}     optional hyperparameter sets, each run on every trait
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import hashlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+import dnngp_results
+
+STATE_FILE = 'scheduler_state.jsonl'
+RUNNER_OPTIONS = ('batch_size', 'lr', 'epoch', 'patience', 'dropout1', 'dropout2', 'seed', 'earlystopping')
+
+
+def expand_jobs(manifest):
+    """One job per trait x parameter set x fold: (job id, dnngp_runner.py options)"""
+    cv = int(manifest.get('cv', 5))
+    folds = manifest.get('folds', 'all')
+    folds = list(range(1, cv + 1)) if folds == 'all' else [int(k) for k in folds]
+    defaults = manifest.get('defaults', {})
+    param_sets = manifest.get('params') or [{}]
+    jobs = []
+    for pheno in manifest['traits']:
+        trait = os.path.splitext(os.path.basename(pheno))[0]
+        for i, params in enumerate(param_sets):
+            name = params.get('name', f"p{i + 1}" if len(param_sets) > 1 else 'default')
+            options = dict(defaults, **{k: v for k, v in params.items() if k != 'name'})
+            unknown = set(options) - set(RUNNER_OPTIONS)
+            if unknown:
+                raise ValueError(f"unknown dnngp_runner.py options in manifest: {sorted(unknown)}")
+            for fold in folds:
+                job_id = f"{trait}/{name}/fold{fold}"
+                jobs.append((job_id, dict(options, snp=manifest['snp'], pheno=pheno, cv=cv, part=fold,
+                                          # trailing separator: the output directory is used as a path prefix
+                                          output=os.path.join(manifest['output'], trait, name, f"fold{fold}", ''))))
+    return jobs
+
+
+def job_key(options):
+    """Hash of a job's arguments; a job is only skipped if it succeeded with exactly these arguments"""
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def finished_jobs(state_file):
+    if not os.path.exists(state_file):
+        return set()
+    return {(r['job'], r['key']) for r in dnngp_results.read_records(state_file) if r.get('status') == 'done'}
+
+
+def cpu_slots(cpus, jobs, pin):
+    """Split the CPU budget into one slot per concurrent job: (threads, CPU ids to pin to or None)"""
+    threads = max(1, cpus // jobs)
+    available = None
+    if pin and hasattr(os, 'sched_getaffinity'):
+        if shutil.which('taskset'):
+            available = sorted(os.sched_getaffinity(0))
+        else:
+            print("taskset not found, the jobs are not pinned to cores")
+    slots = queue.Queue()
+    for i in range(jobs):
+        cores = available[i * threads:(i + 1) * threads] if available else None
+        slots.put((threads, cores or None))
+    return slots
+
+
+def job_env(threads):
+    env = dict(os.environ)
+    env.update({'OMP_NUM_THREADS': str(threads), 'MKL_NUM_THREADS': str(threads),
+                'TF_NUM_INTRAOP_THREADS': str(threads), 'TF_NUM_INTEROP_THREADS': '2', 'PYTHONUNBUFFERED': '1'})
+    return env
+
+
+class Scheduler:
+    def __init__(self, runner, output, jobs=1, cpus=None, pin=False, retries=1):
+        self.runner = runner
+        self.state_file = os.path.join(output, STATE_FILE)
+        self.log_dir = os.path.join(output, 'logs')
+        self.slots = cpu_slots(cpus or os.cpu_count() or 1, jobs, pin)
+        self.jobs = jobs
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.running = set()
+        self.stopping = False
+
+    def command(self, options, cores=None):
+        # Pinned through taskset, which sets the CPU mask before exec: the jobs are started from worker threads,
+        # where a preexec_fn is not safe.
+        command = ['taskset', '-c', ','.join(map(str, cores))] if cores else []
+        command += [sys.executable, '-u', self.runner]
+        for name, value in options.items():
+            command += [f"--{name}", str(value)]
+        return command
+
+    def run_job(self, job_id, options):
+        threads, cores = self.slots.get()
+        try:
+            log_file = os.path.join(self.log_dir, job_id.replace('/', '.') + '.log')
+            os.makedirs(options['output'], exist_ok=True)
+            for attempt in range(1, self.retries + 2):
+                if self.stopping:
+                    return 'stopped'
+                start = time.time()
+                with open(log_file, 'a') as log:
+                    log.write(f"==== {job_id} attempt {attempt}: {' '.join(self.command(options, cores))}\n")
+                    log.flush()
+                    process = subprocess.Popen(self.command(options, cores), stdout=log, stderr=subprocess.STDOUT,
+                                               env=job_env(threads))
+                    with self.lock:
+                        self.running.add(process)
+                    returncode = process.wait()
+                    with self.lock:
+                        self.running.discard(process)
+                status = 'done' if returncode == 0 else 'failed'
+                dnngp_results.append_record(self.state_file, {
+                    'job': job_id, 'key': job_key(options), 'status': status, 'attempt': attempt,
+                    'returncode': returncode, 'seconds': time.time() - start, 'log': log_file})
+                print(f"{job_id}: {status} (attempt {attempt}, {time.time() - start:.0f} Seconds)", flush=True)
+                if status == 'done':
+                    return status
+            return 'failed'
+        finally:
+            self.slots.put((threads, cores))
+
+    def run(self, jobs):
+        os.makedirs(self.log_dir, exist_ok=True)
+        done = finished_jobs(self.state_file)
+        pending = [(job_id, options) for job_id, options in jobs if (job_id, job_key(options)) not in done]
+        print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already finished, {len(pending)} to run", flush=True)
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        futures = [executor.submit(self.run_job, job_id, options) for job_id, options in pending]
+        try:
+            results = [future.result() for future in futures]
+        except KeyboardInterrupt:
+            self.stopping = True
+            with self.lock:
+                for process in self.running:
+                    process.terminate()
+            executor.shutdown(wait=True)
+            raise
+        executor.shutdown()
+        return results
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='Run a manifest of dnngp_runner.py trainings in parallel')
+    parser.add_argument('manifest', help='JSON manifest of traits, folds and hyperparameters')
+    parser.add_argument('--jobs', type=int, default=1, help='jobs running at the same time, default=1')
+    parser.add_argument('--cpus', type=int, default=None, help='CPU cores shared by the jobs, default=all')
+    parser.add_argument('--pin', action='store_true', help='pin each job to its own cores with taskset (Linux)')
+    parser.add_argument('--retries', type=int, default=1, help='extra attempts for a failed job, default=1')
+    parser.add_argument('--runner', default=os.path.join(script_dir, 'dnngp_runner.py'),
+                        help='training script, e.g. M1/dnngp_runner.py on Mac M1, default=dnngp_runner.py')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    start_model = time.time()
+    opt = get_options()
+    with open(opt.manifest) as f:
+        manifest = json.load(f)
+    scheduler = Scheduler(os.path.abspath(opt.runner), manifest['output'], opt.jobs, opt.cpus, opt.pin, opt.retries)
+    results = scheduler.run(expand_jobs(manifest))
+    failed = results.count('failed')
+    print(f"{results.count('done')} jobs done, {failed} failed, state in: {scheduler.state_file}")
+    print('Running time: %s Seconds' % (time.time() - start_model))
+    sys.exit(1 if failed else 0)
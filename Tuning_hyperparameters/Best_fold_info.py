@@ -1,12 +1,21 @@
 import json
+import os
 import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 '''
 This script is used to deal with the problem that the best parameter json file and the running log are difficult to correspond.
-You only need to change the path of the last line to your directory, and the script will automatically find the lowest directory, 
+You only need to change the path of the last line to your directory, and the script will automatically find the lowest directory,
 automatically read the unique json file and the.log file inside, and update the best parameter fold information to the json file.
+If the directory also holds the tuning_trials.jsonl records written by DNNGP_OPN.py, they are used instead of the log.
+Each log is streamed once into an index of trial -> fold statistics, the directories are processed in parallel,
+and every trial of every directory is written to tuning_summary.sqlite in the root directory for later queries.
 '''
+KEYS_TO_MATCH = ["batch", "lr", "patience", "dropout1", "dropout2", "earlystopping"]
+SUMMARY_FILE = "tuning_summary.sqlite"
+
 def parse_parameters(line: str) -> Optional[Dict]:
     """Parsing of parameters"""
     param_pattern = {
@@ -18,7 +27,7 @@ def parse_parameters(line: str) -> Optional[Dict]:
         "earlystopping": r"earlystopping: (.+?)\s",
         "tsv_file": r"tsv_file: (\S+\.tsv)"
     }
-    
+
     params = {}
     for key, pattern in param_pattern.items():
         match = re.search(pattern, line)
@@ -27,74 +36,110 @@ def parse_parameters(line: str) -> Optional[Dict]:
         params[key] = match.group(1).strip()
     return params
 
-def find_closest_statistics(log_lines: List[str], param_line_num: int) -> List[str]:
+def parse_statistics(line: str) -> List[str]:
     """Statistical value extraction"""
-    for i in range(param_line_num, len(log_lines)):
-        if "Statistic values for all folds" in log_lines[i]:
-            values_str = log_lines[i].split("[")[1].split("]")[0]
-            return [v.strip() for v in values_str.split(",")]
-    return []
+    values_str = line.split("[")[1].split("]")[0]
+    return [v.strip() for v in values_str.split(",")]
+
+def trial_key(tsv_name: str, params: Dict) -> Tuple:
+    return (tsv_name,) + tuple(str(params.get(k, "")) for k in KEYS_TO_MATCH)
 
-def match_string_parameters(config_params: Dict, log_params: Dict) -> bool:
-    """String matching"""
-    keys_to_match = ["batch", "lr", "patience", 
-                    "dropout1", "dropout2", "earlystopping"]
-    return all(
-        config_params.get(k, "") == log_params.get(k, "")
-        for k in keys_to_match
-    )
+def index_log(log_file: Path) -> Dict[Tuple, List[str]]:
+    """Stream a log once; every parameter line is paired with the next 'Statistic values for all folds' line"""
+    index = {}
+    pending = []
+    with open(log_file, 'r', errors='ignore') as f:
+        for line in f:
+            if "Statistic values for all folds" in line:
+                stats = parse_statistics(line)
+                for key in pending:
+                    index[key] = stats
+                pending = []
+            elif "batch:" in line:
+                params = parse_parameters(line)
+                if params:
+                    pending.append(trial_key(params["tsv_file"], params))
+    return index
 
-def process_directory(dir_path: Path):
+def index_records(trials_file: Path) -> Dict[Tuple, List[float]]:
+    """Index of the fully evaluated trials in a tuning_trials.jsonl file written by DNNGP_OPN.py"""
+    index = {}
+    with open(trials_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("pruned_at") is not None:
+                continue
+            params = dict(record["params"], batch=record["params"]["batch_size"])
+            index[trial_key(record["tsv_file"], params)] = record["statistics"]
+    return index
+
+def to_floats(stats: Iterable) -> List[float]:
+    try:
+        return [float(v) for v in stats]
+    except ValueError:
+        return []
+
+def process_directory(dir_path: Path) -> List[Tuple]:
+    """Update the json file of one directory and return its summary rows"""
     try:
         json_file = next(dir_path.glob("*.json"))
-        log_file = next(dir_path.glob("*.log"))
     except StopIteration:
-        return
+        return []
+    trials_file = dir_path / "tuning_trials.jsonl"
+    if trials_file.exists():
+        index = index_records(trials_file)
+    else:
+        try:
+            log_file = next(dir_path.glob("*.log"))
+        except StopIteration:
+            return []
+        index = index_log(log_file)
 
     with open(json_file, 'r+') as f:
         config = json.load(f)
-        log_lines = open(log_file, 'r').readlines()
-        
-        param_white_list = {}
+        best_keys = {}
         for tsv_name, entries in config.items():
-            param_white_list[tsv_name] = {
-                "batch": str(entries[1]["batch_size"]),
-                "lr": str(entries[1]["lr"]),
-                "patience": str(entries[1]["patience"]),
-                "dropout1": str(entries[1]["dropout1"]),
-                "dropout2": str(entries[1]["dropout2"]),
-                "earlystopping": str(entries[1]["earlystopping"])
-            }
-        
-        matched_stats = {}
-        for line_num, line in enumerate(log_lines):
-            params = parse_parameters(line)
-            if not params:
-                continue
-            
-            tsv_name = params["tsv_file"]
-            if tsv_name not in param_white_list:
-                continue
-            
-            if match_string_parameters(param_white_list[tsv_name], params):
-                stats = find_closest_statistics(log_lines, line_num)
-                if stats:
-                    matched_stats[tsv_name] = stats
-        
-        for tsv_name, stats in matched_stats.items():
-            try:
-                config[tsv_name][0] = [float(v) for v in stats]
-            except ValueError:
-                config[tsv_name][0] = []
-        
+            params = dict(entries[1], batch=entries[1]["batch_size"])
+            best_keys[tsv_name] = trial_key(tsv_name, params)
+            if best_keys[tsv_name] in index:
+                config[tsv_name][0] = to_floats(index[best_keys[tsv_name]])
+
         f.seek(0)
         json.dump(config, f, indent=4)
         f.truncate()
 
-def main(root_dir: Path):
-    for dir_path in root_dir.rglob('*'):
-        if dir_path.is_dir():
-            process_directory(dir_path)
+    best = set(best_keys.values())
+    rows = []
+    for key, stats in index.items():
+        values = to_floats(stats)
+        mean = sum(values) / len(values) if values else None
+        var = sum((v - mean) ** 2 for v in values) / len(values) if values else None
+        rows.append((str(dir_path),) + key + (json.dumps(values), mean, var, int(key in best)))
+    return rows
+
+def write_summary(summary_file: Path, rows: List[Tuple]):
+    conn = sqlite3.connect(str(summary_file))
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS trials")
+        conn.execute("CREATE TABLE trials (directory TEXT, tsv_file TEXT, batch TEXT, lr TEXT, patience TEXT, "
+                     "dropout1 TEXT, dropout2 TEXT, earlystopping TEXT, statistics TEXT, mean REAL, var REAL, "
+                     "best INTEGER)")
+        conn.executemany("INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("CREATE INDEX trials_tsv ON trials (tsv_file, mean)")
+    conn.close()
+
+def main(root_dir: Path, workers: Optional[int] = None):
+    dirs = [Path(dir_name) for dir_name, _, files in os.walk(root_dir)
+            if Path(dir_name) != root_dir and any(name.endswith(".json") for name in files)]
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for dir_rows in executor.map(process_directory, dirs):
+            rows.extend(dir_rows)
+    write_summary(root_dir / SUMMARY_FILE, rows)
+    print(f"{len(dirs)} directories, {len(rows)} trials summarized in {root_dir / SUMMARY_FILE}")
 
 if __name__ == "__main__":
     main(Path(r"Your/path/"))
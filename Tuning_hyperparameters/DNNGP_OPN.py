@@ -1,11 +1,21 @@
 # DNNGP3 tuning hyperparameters script
 import os
-import re
+import sys
+import shutil
+import tempfile
 import json
+import hashlib
 import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
 import nevergrad as ng
 import tensorflow as tf
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+import dnngp_results
+import dnngp_worker
+from trial_cache import TrialCache, trait_key, schedule_key
 # The script needs to set parameters in three places, one is the #10 directory location, the second is the #21 hyperparameter search space, and the third is the #49 DNNGP native command.
 # Set priorities in descending order, except for the directory, the default parameters are sufficient for most requests.
 # Define directories and file paths
@@ -15,8 +25,30 @@ budget = 200  # Optimize the number of script iterations
 alpha = 0.7  # The larger the value, the more focused the optimization is on the cross-validated mean.
 beta = 0.1  # The larger the value, the more focused the optimization is on cross-validation stability.
 cvs = 10 # K-fold cross-validation
+use_worker_pool = True  # Keep long-lived workers that import TensorFlow and load the data once, instead of one dnngp_runner.py process per fold.
+pool_workers = 1  # Number of long-lived worker processes, i.e. how many folds of a trial are trained at the same time.
+intra_op_threads = max(1, (os.cpu_count() or 1) // pool_workers)  # TensorFlow threads per worker, keep pool_workers * intra_op_threads <= CPU cores.
+inter_op_threads = 2
+trial_workers = 1  # Number of candidates evaluated at the same time, shared by all tsv files (they all run the folds on the same worker pool).
+keep_trial_outputs = False  # With trial_workers > 1 every evaluation trains in its own directory, which is deleted after its folds are read; True keeps the models and histories.
+scripts_dir = r'../Scripts'
+seed = 123
+use_trial_cache = True  # Store every fold result in SQLite so that an interrupted run can be resumed and repeated points are not retrained.
+cache_file = None  # Defaults to tuning_cache.sqlite next to the pkl file.
+init_from = None  # Warm start every trial from a trained model of the same architecture (e.g. r'../Output_files/training.model.h5') instead of random weights.
+epoch = 10000  # Maximum epochs of a fully evaluated trial, earlystopping usually ends training much earlier.
+use_pruning = False  # Successive halving (ASHA): evaluate trials on growing (folds, epochs) budgets and stop the losing ones early.
+rungs = [(2, 2000), (5, 5000), (cvs, epoch)]  # (number of folds, epochs) of each rung, the last rung is the full evaluation.
+reduction_factor = 3  # Only the best 1/reduction_factor of the trials that reached a rung are promoted to the next one.
+worker_pool = None
+trial_cache = None
+trait_keys = {}
+rung_losses = {}
+rung_lock = threading.Lock()
 
 pkl_dir = os.path.dirname(pkl_file)
+# One JSON record per trial (parameters, fold statistics, loss), read by Best_fold_info.py
+trials_file = os.path.join(pkl_dir, 'tuning_trials.jsonl')
 # Obtain all tsv files in the directory where the pkl file resides
 tsv_files = [f for f in os.listdir(pkl_dir) if f.endswith('.tsv')]
 
@@ -38,7 +70,6 @@ def check_gpu_available():
     else:
         print("⚠️ No GPU detected, will use CPU")
         return False
-check_gpu_available()
 # Define hyperparameters search space (see https://github.com/facebookresearch/nevergrad)
 instr = ng.p.Instrumentation(
     batch_size=ng.p.Scalar(lower=32, upper=1024).set_integer_casting(),
@@ -49,40 +80,63 @@ instr = ng.p.Instrumentation(
     earlystopping=ng.p.Scalar(lower=50, upper=100).set_integer_casting()
 )
 
-# Define a function to extract statistic values
+# Define the objective function
 
-def extract_statistics(output):
-    statistics = re.findall(r'statistic=([-+]?[0-9]*\.?[0-9]+)', output)
-    if not statistics:
-        return 0.0
-    statistic_values = float(statistics[0])
-    return statistic_values
 
-# Define the objective function
+def trial_output(params, tsv_file, epoch):
+    """Output directory of one evaluation: output_dir itself when one trial runs at a time, otherwise its own
+    output_dir/<trait>/<trial hash>-<random>/
 
+    dnngp.main names its model, history and validation files only by the output prefix and the fold, so
+    concurrent trials (of the same or of different tsv files) must not share a directory.
+    """
+    if trial_workers == 1:
+        return output_dir
+    trial_hash = hashlib.sha1(json.dumps(dict(params, epoch=epoch), sort_keys=True).encode()).hexdigest()[:12]
+    trait_dir = os.path.join(output_dir, os.path.splitext(tsv_file)[0])
+    os.makedirs(trait_dir, exist_ok=True)
+    return os.path.join(tempfile.mkdtemp(prefix=trial_hash + '-', dir=trait_dir), '')
 
-def objective(batch_size: int, lr: float, patience: int, dropout1: float, dropout2: float, earlystopping: int, tsv_file: str):
-    accuracies = []
-    print('batch:',batch_size, 'lr:', lr, 'patience:', patience, 'dropout1:', dropout1, 'dropout2:', dropout2, 'earlystopping:', earlystopping, 'tsv_file:', tsv_file)
 
-    for part in range(1, cvs + 1):
-        command = f"python ../Scripts/dnngp_runner.py --batch_size {batch_size} --epoch 10000 --lr {lr} --patience {patience} --dropout1 {dropout1} --dropout2 {dropout2} --earlystopping {earlystopping} --cv {cvs} --part {part} --snp {pkl_file} --pheno {os.path.join(pkl_dir, tsv_file)} --output {output_dir}"
+def run_folds(params, tsv_file, parts, epoch):
+    """Train the given folds of one parameter set, returns (result record, stderr) per fold in the order of parts
+
+    A per-trial directory is removed once the fold records are read (they are kept in dnngp_results.jsonl),
+    unless keep_trial_outputs is set.
+    """
+    trial_dir = trial_output(params, tsv_file, epoch)
+    try:
+        return train_folds(params, tsv_file, parts, epoch, trial_dir)
+    finally:
+        if trial_dir != output_dir and not keep_trial_outputs:
+            shutil.rmtree(trial_dir, ignore_errors=True)
+
+
+def train_folds(params, tsv_file, parts, epoch, trial_dir):
+    if worker_pool is not None:
+        jobs = [dict(params, snp=pkl_file, pheno=os.path.join(pkl_dir, tsv_file), epoch=epoch, output=trial_dir,
+                     seed=seed, cv=cvs, part=part) for part in parts]
+        # All folds are dispatched at once; map() returns the results in fold order.
+        return worker_pool.map(dnngp_worker.run_fold, jobs, chunksize=1)
+    results = []
+    for part in parts:
+        fd, result_file = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        command = f"python ../Scripts/dnngp_runner.py --batch_size {params['batch_size']} --epoch {epoch} --lr {params['lr']} --patience {params['patience']} --dropout1 {params['dropout1']} --dropout2 {params['dropout2']} --earlystopping {params['earlystopping']} --cv {cvs} --part {part} --snp {pkl_file} --pheno {os.path.join(pkl_dir, tsv_file)} --output {trial_dir} --result_json {result_file}"
+        if init_from:
+            command += f" --init_from {init_from}"
         print(command)
         p = subprocess.Popen(command, shell=True,
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         output, error = p.communicate()
 
-        # Decode output
-        output_str = output.decode(errors='ignore')
-        error_str = error.decode(errors='ignore')
-
-        if error_str:
-            print("Error Output:", error_str)
+        records = dnngp_results.read_records(result_file)
+        os.remove(result_file)
+        results.append((records[-1] if records else None, error.decode(errors='ignore')))
+    return results
 
-        accuracy = extract_statistics(output_str)
-        accuracies.append(accuracy)
-    print("Statistic values for all folds", accuracies)
 
+def combined_loss(accuracies):
     mean_accuracy = np.mean(accuracies) if accuracies else 0.0
     var_accuracy = np.var(accuracies) if accuracies else 0.0
 
@@ -94,23 +148,187 @@ def objective(batch_size: int, lr: float, patience: int, dropout1: float, dropou
     return -combined_metric
 
 
-# Record the best parameters and results for each tsv file
-best_params_per_tsv = {}
+def cached_folds(params, tsv_file, parts, epoch):
+    """Fold statistics of one parameter set found in the trial cache, by fold
+
+    A fold trained for another rung is reused when early stopping ended it before both epoch caps.
+    """
+    statistics = {}
+    if trial_cache is not None:
+        caps = [rung_epoch for _, rung_epoch in trial_schedule()[0]]
+        for part in parts:
+            statistic = trial_cache.get_fold(trait_keys[tsv_file], dict(params, epoch=epoch), part, caps)
+            if statistic is not None:
+                statistics[part] = statistic
+    return statistics
+
+
+def evaluate_folds(params, tsv_file, parts, epoch):
+    """Fold statistics of one parameter set, taken from the trial cache where possible
+
+    Returns (statistics in the order of parts, whether every fold succeeded).
+    """
+    fold_params = dict(params, epoch=epoch)
+    statistics = cached_folds(params, tsv_file, parts, epoch)
+    missing = [part for part in parts if part not in statistics]
+    failed = False
+
+    for part, (record, error_str) in zip(missing, run_folds(params, tsv_file, missing, epoch)):
+        if error_str:
+            print("Error Output:", error_str)
+
+        if record is None or record['correlation'] is None:
+            # Failed folds count as 0 and are not cached; the trial is not stored either, so a restarted run
+            # evaluates it again instead of replaying a loss that includes the failure.
+            statistics[part] = 0.0
+            failed = True
+            continue
+        dnngp_results.append_record(os.path.join(output_dir, dnngp_results.RESULT_FILE), dict(record, tsv_file=tsv_file))
+        statistics[part] = record['correlation']
+        if trial_cache is not None:
+            trial_cache.put_fold(trait_keys[tsv_file], fold_params, part, record['correlation'], record.get('epochs_run'))
+    return [statistics[part] for part in parts], not failed
+
+
+def promote(tsv_file, rung, loss):
+    """ASHA rule: continue a trial if it is among the best 1/reduction_factor of the trials seen at this rung"""
+    with rung_lock:
+        losses = rung_losses.setdefault((tsv_file, rung), [])
+        losses.append(loss)
+        if len(losses) < reduction_factor:
+            return True
+        return loss <= sorted(losses)[len(losses) // reduction_factor - 1]
+
+
+def replay_rungs(params, tsv_file):
+    """Put the rung losses of a cached trial back into rung_losses, recomputed from its cached folds, so a resumed
+    run prunes against the trials evaluated before the restart"""
+    for rung, (n_folds, rung_epoch) in enumerate(trial_schedule()[0][:-1]):
+        statistics = cached_folds(params, tsv_file, range(1, n_folds + 1), rung_epoch)
+        if len(statistics) < n_folds:  # the trial was pruned before this rung
+            break
+        with rung_lock:
+            rung_losses.setdefault((tsv_file, rung), []).append(combined_loss([statistics[part] for part in sorted(statistics)]))
+
+
+def trial_schedule():
+    """(folds, epochs) rungs of a trial and the cache key of that schedule"""
+    schedule = rungs if use_pruning else [(cvs, epoch)]
+    return schedule, schedule_key(schedule, reduction_factor if use_pruning else None)
+
+
+def objective(batch_size: int, lr: float, patience: int, dropout1: float, dropout2: float, earlystopping: int, tsv_file: str):
+    params = dict(batch_size=batch_size, lr=lr, patience=patience, dropout1=dropout1, dropout2=dropout2, earlystopping=earlystopping)
+    params_line = ' '.join(map(str, ['batch:', batch_size, 'lr:', lr, 'patience:', patience, 'dropout1:', dropout1, 'dropout2:', dropout2, 'earlystopping:', earlystopping, 'tsv_file:', tsv_file]))
+
+    schedule, schedule_id = trial_schedule()
+    for rung, (n_folds, rung_epoch) in enumerate(schedule):
+        accuracies, complete = evaluate_folds(params, tsv_file, list(range(1, n_folds + 1)), rung_epoch)
+        loss = combined_loss(accuracies)
+        if rung == len(schedule) - 1:
+            break
+        if not promote(tsv_file, rung, loss):
+            print(f"Pruned at rung {rung} ({n_folds} folds, {rung_epoch} epochs), loss {loss}: {params} {tsv_file}")
+            dnngp_results.append_record(trials_file, dict(tsv_file=tsv_file, params=params, statistics=accuracies,
+                                                          loss=float(loss), pruned_at=rung))
+            if trial_cache is not None and complete:
+                trial_cache.put_trial(trait_keys[tsv_file], params, tsv_file, loss, schedule_id)
+            return loss
+
+    # Parameters and statistics are written in one call so that concurrent trials cannot interleave them in the log (Best_fold_info.py pairs them up).
+    sys.stdout.write(f"{params_line}\nStatistic values for all folds {accuracies}\n")
+    sys.stdout.flush()
+    dnngp_results.append_record(trials_file, dict(tsv_file=tsv_file, params=params, statistics=accuracies,
+                                                  loss=float(loss), pruned_at=None))
+    if trial_cache is not None and complete:
+        trial_cache.put_trial(trait_keys[tsv_file], params, tsv_file, loss, schedule_id)
+
+    return loss
+
+
+def optimize_traits(tsv_files, on_finished=None):
+    """Run one Nevergrad optimizer per tsv file with ask/tell, keeping trial_workers candidates in flight
+
+    Trials already stored in the trial cache are replayed into the optimizers first and count towards the budget.
+    on_finished(tsv_file, recommendation) is called as soon as a tsv file has used up its budget.
+    """
+    optimizers = {tsv_file: ng.optimizers.NGOpt(parametrization=instr.copy(), budget=budget, num_workers=trial_workers)
+                  for tsv_file in tsv_files}
+    asked = {tsv_file: 0 for tsv_file in tsv_files}
+    told = {tsv_file: 0 for tsv_file in tsv_files}
+    if trial_cache is not None:
+        for tsv_file, optimizer in optimizers.items():
+            for params, loss in trial_cache.finished_trials(trait_keys[tsv_file], trial_schedule()[1])[:budget]:
+                optimizer.tell(optimizer.parametrization.spawn_child(new_value=((), params)), loss)
+                if use_pruning:
+                    replay_rungs(params, tsv_file)
+                asked[tsv_file] += 1
+                told[tsv_file] += 1
+            if told[tsv_file]:
+                print(f"Replayed {told[tsv_file]} cached trials for {tsv_file}")
+    if on_finished is not None:
+        for tsv_file in tsv_files:
+            if told[tsv_file] >= budget:
+                on_finished(tsv_file, optimizers[tsv_file].provide_recommendation())
+    in_flight = {tsv_file: 0 for tsv_file in tsv_files}
+    running = {}
+    with ThreadPoolExecutor(max_workers=trial_workers) as executor:
+        while True:
+            while len(running) < trial_workers:
+                open_files = [f for f in tsv_files if asked[f] < budget]
+                if not open_files:
+                    break
+                # Spread the free slots over the tsv files that have the fewest candidates running.
+                tsv_file = min(open_files, key=lambda f: in_flight[f])
+                candidate = optimizers[tsv_file].ask()
+                asked[tsv_file] += 1
+                in_flight[tsv_file] += 1
+                future = executor.submit(objective, *candidate.args, **candidate.kwargs, tsv_file=tsv_file)
+                running[future] = (tsv_file, candidate)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tsv_file, candidate = running.pop(future)
+                in_flight[tsv_file] -= 1
+                optimizers[tsv_file].tell(candidate, future.result())
+                told[tsv_file] += 1
+                if on_finished is not None and told[tsv_file] == budget:
+                    on_finished(tsv_file, optimizers[tsv_file].provide_recommendation())
+    return {tsv_file: optimizer.provide_recommendation() for tsv_file, optimizer in optimizers.items()}
+
+
+if __name__ == '__main__':
+    check_gpu_available()
+    if use_worker_pool:
+        # The OpenMP/MKL pools are sized when a process starts, so the limit is passed to the workers through the environment.
+        os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+        os.environ['MKL_NUM_THREADS'] = str(intra_op_threads)
+        # TensorFlow is not fork-safe, so the workers are started with spawn.
+        worker_pool = multiprocessing.get_context('spawn').Pool(pool_workers, initializer=dnngp_worker.init_worker,
+                                                               initargs=(scripts_dir, intra_op_threads, inter_op_threads, init_from))
+    if use_trial_cache:
+        trial_cache = TrialCache(cache_file or os.path.join(pkl_dir, 'tuning_cache.sqlite'))
+        warm_start = {'init_from': init_from} if init_from else {}  # warm-started trials are cached apart
+        trait_keys = {tsv_file: trait_key(pkl_file, os.path.join(pkl_dir, tsv_file), cv=cvs, seed=seed, **warm_start)
+                      for tsv_file in tsv_files}
+    # Record the best parameters and results for each tsv file
+    output_json_file = os.path.join(pkl_dir, 'best_params_per_tsv.json')
+    best_params_per_tsv = {}
+
+    def save_best_params(tsv_file, recommendation):
+        # Output optimum parameter, the JSON file is rewritten as soon as each tsv file finishes
+        print(f"Best parameters for {tsv_file}:", recommendation.value)
+        best_params_per_tsv[tsv_file] = recommendation.value
+        with open(output_json_file, 'w') as file:
+            json.dump(best_params_per_tsv, file, indent=4)
 
-for tsv_file in tsv_files:
-    print(f"Optimizing for TSV file: {tsv_file}")
-    # Use Nevergrad's optimizer
-    optimizer = ng.optimizers.NGOpt(parametrization=instr, budget=budget)
+    print(f"Optimizing for TSV files: {tsv_files}")
     # Execution optimization procedure
-    recommendation = optimizer.minimize(
-        lambda *args, **kwargs: objective(*args, **kwargs, tsv_file=tsv_file)
-    )
-    # Output optimum parameter
-    print(f"Best parameters for {tsv_file}:", recommendation.value)
-    best_params_per_tsv[tsv_file] = recommendation.value
-
-# Output best_params_per_tsv to a JSON file
-output_json_file = os.path.join(pkl_dir, 'best_params_per_tsv.json')
-with open(output_json_file, 'w') as file:
-    json.dump(best_params_per_tsv, file, indent=4)
-print(f"Best parameters saved to {output_json_file}")
+    optimize_traits(tsv_files, on_finished=save_best_params)
+    print(f"Best parameters saved to {output_json_file}")
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+    if trial_cache is not None:
+        trial_cache.close()
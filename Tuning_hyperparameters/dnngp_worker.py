@@ -0,0 +1,53 @@
+# Long-lived DNNGP worker used by DNNGP_OPN.py in worker-pool mode.
+# Each worker imports TensorFlow and the compiled dnngp module once, calls dnngp.prepare() once,
+# and keeps the genotype pickle in memory, so a (hyperparameters, fold) job only pays for training.
+import os
+import sys
+import traceback
+
+_dnngp = None
+_dnngp_results = None
+_tf = None
+
+
+def init_worker(scripts_dir, intra_op_threads=0, inter_op_threads=0, init_from=None):
+    """Pool initializer: import the DNNGP runtime once per worker process
+
+    intra_op_threads/inter_op_threads limit the CPU threads of this worker (0 lets TensorFlow decide),
+    so that several workers training folds side by side do not oversubscribe the machine.
+    init_from: trained model of the same architecture that initializes every job's network (warm start).
+    """
+    global _dnngp, _dnngp_results, _tf
+    sys.path.insert(0, os.path.abspath(scripts_dir))
+    import tensorflow as tf
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    import dnngp
+    import dnngp_results
+    import genotype_store
+    import dnngp_checkpoint
+    # Keep every genotype pickle read by dnngp.main in memory for the lifetime of the worker.
+    genotype_store.install_reader(cache=True)
+    dnngp_checkpoint.Checkpointer(init_from=init_from).install()
+    dnngp.prepare()
+    _dnngp = dnngp
+    _dnngp_results = dnngp_results
+    _tf = tf
+
+
+def run_fold(job):
+    """Train one fold and return (result record, error), the record is None if the fold failed"""
+    record = None
+    error = ''
+    try:
+        record, _ = _dnngp_results.run_main(_dnngp, job['snp'], job['pheno'], job['batch_size'], job['lr'], job['epoch'],
+                                            job['patience'], job['dropout1'], job['dropout2'], job['output'],
+                                            job['seed'], job['cv'], job['part'], job['earlystopping'], echo=False)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        # Drop the graph of the finished fold so a worker does not grow over thousands of jobs.
+        _tf.keras.backend.clear_session()
+    return record, error
@@ -0,0 +1,99 @@
+# On-disk trial cache used by DNNGP_OPN.py.
+# Every fold result is stored in SQLite under a key built from the hashes of the genotype and phenotype files,
+# so a killed tuning run can be restarted: finished trials are replayed into the optimizer and cached folds are skipped.
+# Trial losses are only comparable under the same evaluation schedule (pruning rungs), so trials are stored with it.
+# Folds are stored with the epochs they ran, so a fold that early stopping ended before an epoch cap answers for other caps.
+import json
+import hashlib
+import sqlite3
+import threading
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def trait_key(pkl_file, tsv_file, **settings):
+    """Key of one (genotype, phenotype, fold settings) combination, e.g. settings cv/seed"""
+    digest = hashlib.sha256()
+    digest.update(file_hash(pkl_file).encode())
+    digest.update(file_hash(tsv_file).encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def schedule_key(rungs, reduction_factor=None):
+    """Key of the (folds, epochs) rungs a trial loss was computed on, with the pruning reduction factor"""
+    return json.dumps({'rungs': [list(rung) for rung in rungs], 'reduction_factor': reduction_factor})
+
+
+class TrialCache:
+    """SQLite store of fold statistics and finished trials, safe to share between threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS folds (trait TEXT, params TEXT, fold INTEGER, "
+                              "statistic REAL, epochs_run INTEGER, PRIMARY KEY (trait, params, fold))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS trials (trait TEXT, params TEXT, tsv_file TEXT, "
+                              "loss REAL, schedule TEXT, PRIMARY KEY (trait, params))")
+            # Caches written by older versions lack these columns; their trials (loss NULL) are not replayed, and
+            # their folds (epochs_run NULL) are only used for their own epoch cap.
+            for table, column, kind in (('trials', 'loss', 'REAL'), ('trials', 'schedule', 'TEXT'),
+                                        ('folds', 'epochs_run', 'INTEGER')):
+                if column not in {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+    def get_fold(self, trait, params, fold, caps=()):
+        """Statistic of a fold trained with params (which include the epoch cap), or None
+
+        A fold trained with the same parameters under another epoch cap in caps is used as well when it ran fewer
+        epochs than both caps: early stopping ended it, so training under either cap runs the same epochs.
+        """
+        epoch = params['epoch']
+        keys = {params_key(dict(params, epoch=cap)): cap for cap in caps}
+        keys[params_key(params)] = epoch
+        with self.lock:
+            rows = self.conn.execute(f"SELECT params, statistic, epochs_run FROM folds WHERE trait=? AND fold=? AND "
+                                     f"params IN ({', '.join('?' * len(keys))})", (trait, fold, *keys)).fetchall()
+        rows = {key: (statistic, epochs_run) for key, statistic, epochs_run in rows}
+        if params_key(params) in rows:
+            return rows[params_key(params)][0]
+        for key, (statistic, epochs_run) in rows.items():
+            if epochs_run is not None and epochs_run < min(keys[key], epoch):
+                return statistic
+        return None
+
+    def put_fold(self, trait, params, fold, statistic, epochs_run=None):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO folds (trait, params, fold, statistic, epochs_run) "
+                              "VALUES (?, ?, ?, ?, ?)", (trait, params_key(params), fold, statistic, epochs_run))
+
+    def put_trial(self, trait, params, tsv_file, loss, schedule):
+        """Record a finished (or pruned) trial together with the loss that was told to the optimizer and the
+        schedule (schedule_key) it was evaluated on"""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO trials (trait, params, tsv_file, loss, schedule) "
+                              "VALUES (?, ?, ?, ?, ?)", (trait, params_key(params), tsv_file, loss, schedule))
+
+    def finished_trials(self, trait, schedule):
+        """(parameters, loss) of every finished trial of a trait evaluated on the same schedule, in the order they
+        finished"""
+        with self.lock:
+            rows = self.conn.execute("SELECT params, loss FROM trials WHERE trait=? AND schedule=? AND loss IS NOT NULL "
+                                     "ORDER BY rowid", (trait, schedule)).fetchall()
+        return [(json.loads(key), loss) for key, loss in rows]
+
+    def close(self):
+        self.conn.close()
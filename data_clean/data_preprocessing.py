@@ -1,22 +1,102 @@
 # -*- coding: utf-8 -*-
 """
 数据预处理工具 - 处理缺失值和数据对齐
+
+SNP矩阵按列块只遍历一次: 每个块内同时统计缺失值(NaN)、Inf、检出率和次等位基因频率(MAF, 仅0/1/2剂量数据)，
+并就地填补该块中的缺失值(零值/均值/众数)，不再为isnull/fillna/replace等操作复制整个DataFrame。
+随后按标记检出率、MAF和样本检出率过滤，结果写成pkl或紧凑的内存映射基因型文件(.npy, float32/int8)。
 """
 
 import pandas as pd
+import numpy as np
+import argparse
 import pickle
 import sys
 import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+import genotype_store
+
+IMPUTE_METHODS = ('zero', 'mean', 'mode')
+OUTPUT_FORMATS = ('pkl', 'npy')
+OUTPUT_DTYPES = ('float64', 'float32', 'int8')
+
+
+def qc_impute(values, impute='zero', block_size=2000):
+    """
+    按列块对values(样本 x 标记, float数组)做一次遍历: 统计质量并就地填补非有限值(NaN/Inf)
+
+    返回:
+        markers: 每个标记的 missing(NaN数), inf(Inf数), call_rate(检出率), maf(非剂量列为NaN)
+        sample_call_rate: 每个样本的检出率
+    """
+    if impute not in IMPUTE_METHODS:
+        raise ValueError(f"impute必须是{IMPUTE_METHODS}之一, 而不是{impute}")
+    n_samples, n_markers = values.shape
+    missing = np.zeros(n_markers, dtype=np.int64)
+    inf = np.zeros(n_markers, dtype=np.int64)
+    maf = np.full(n_markers, np.nan)
+    sample_bad = np.zeros(n_samples, dtype=np.int64)
+    for start in range(0, n_markers, block_size):
+        block = values[:, start:start + block_size]  # 视图，填补直接写回values
+        nan = np.isnan(block)
+        bad = ~np.isfinite(block)
+        n_nan, n_bad = nan.sum(axis=0), bad.sum(axis=0)
+        missing[start:start + block.shape[1]] = n_nan
+        inf[start:start + block.shape[1]] = n_bad - n_nan
+        sample_bad += bad.sum(axis=1)
+        called = n_samples - n_bad
+        mean = np.where(bad, 0, block).sum(axis=0) / np.maximum(called, 1)
+        counts = [(block == g).sum(axis=0) for g in (0, 1, 2)]
+        dosage = counts[0] + counts[1] + counts[2] == called  # 每列: 有限值均为0/1/2
+        p = mean / 2
+        maf[start:start + block.shape[1]] = np.where(dosage, np.minimum(p, 1 - p), np.nan)
+        if impute == 'zero':
+            fill = 0
+        elif impute == 'mode':  # 非剂量列没有有意义的众数，使用均值
+            fill = np.where(dosage, np.argmax(counts, axis=0), mean)
+        else:
+            fill = mean
+        if bad.any():
+            np.copyto(block, np.broadcast_to(fill, block.shape[1:]).astype(block.dtype), where=bad)
+    markers = pd.DataFrame({'missing': missing, 'inf': inf, 'call_rate': 1 - (missing + inf) / max(n_samples, 1),
+                            'maf': maf})
+    return markers, 1 - sample_bad / max(n_markers, 1)
+
+
+def aligned_values(snp_df, rows, dtype, block_size=2000):
+    """SNP矩阵中rows行的float数组; 不需要重排且类型一致时直接使用原数组，否则按列块复制"""
+    source = snp_df.to_numpy()
+    if (len(rows) == len(source) and (rows == np.arange(len(rows))).all() and source.dtype == dtype
+            and source.flags.writeable and source.flags.c_contiguous):
+        return source
+    values = np.empty((len(rows), source.shape[1]), dtype=dtype)
+    for start in range(0, source.shape[1], block_size):
+        values[:, start:start + block_size] = source[rows, start:start + block_size]
+    return values
+
 
-def clean_and_align_data(snp_file, pheno_file, output_dir):
+def clean_and_align_data(snp_file, pheno_file, output_dir, impute='zero', min_call_rate=0.0, min_maf=0.0,
+                         min_sample_call_rate=0.0, output_format='pkl', dtype='float64', block_size=2000):
     """
     清理并对齐SNP和表型数据
     
     参数:
-        snp_file: SNP文件路径 (.pkl)
+        snp_file: SNP文件路径 (.pkl, 或内存映射的基因型文件 .npy)
         pheno_file: 表型文件路径 (.tsv)
         output_dir: 输出目录
+        impute: SNP缺失值(NaN/Inf)的填补方式, zero(填0)/mean(均值)/mode(众数)
+        min_call_rate, min_maf: 标记的最低检出率和最低MAF(基于全部共同样本统计)
+        min_sample_call_rate: 样本的最低检出率
+        output_format: pkl(DataFrame) 或 npy(内存映射的基因型文件)
+        dtype: 输出的数据类型, float64/float32/int8(仅0/1/2剂量数据)
+        block_size: 每次处理的标记列数
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format必须是{OUTPUT_FORMATS}之一, 而不是{output_format}")
+    if dtype not in OUTPUT_DTYPES:
+        raise ValueError(f"dtype必须是{OUTPUT_DTYPES}之一, 而不是{dtype}")
+    if output_format == 'npy' and dtype not in genotype_store.DTYPES:
+        raise ValueError(f"npy输出只支持{genotype_store.DTYPES}")
     print("="*60)
     print("数据预处理工具".center(60))
     print("="*60)
@@ -26,8 +106,11 @@ def clean_and_align_data(snp_file, pheno_file, output_dir):
     
     # 1. 读取SNP数据
     print(f"\n正在读取SNP文件: {snp_file}")
-    with open(snp_file, 'rb') as f:
-        snp_df = pickle.load(f)
+    if genotype_store.is_store(snp_file):
+        snp_df = genotype_store.load(snp_file)
+    else:
+        with open(snp_file, 'rb') as f:
+            snp_df = pickle.load(f)
     print(f"SNP数据形状: {snp_df.shape}")
     print(f"SNP样本数: {len(snp_df)}")
     
@@ -54,49 +137,90 @@ def clean_and_align_data(snp_file, pheno_file, output_dir):
         print(f"表型样本示例: {list(pheno_clean.index[:5])}")
         return False
     
-    # 5. 对齐数据
-    snp_aligned = snp_df.loc[common_samples]
+    # 5. 对齐数据(按列块取出共同样本，float32/int8输出时使用float32工作数组)
+    rows = snp_df.index.get_indexer(common_samples)
+    markers = snp_df.columns
+    values = aligned_values(snp_df, rows, np.float64 if dtype == 'float64' else np.float32, block_size)
+    del snp_df
     pheno_aligned = pheno_clean.loc[common_samples]
     
     print(f"\n对齐后数据:")
-    print(f"  SNP形状: {snp_aligned.shape}")
+    print(f"  SNP形状: {values.shape}")
     print(f"  表型形状: {pheno_aligned.shape}")
     
-    # 6. 检查数据质量
+    # 6. 检查数据质量并就地填补SNP中的异常值(一次遍历)
     print("\n数据质量检查:")
-    snp_nan = snp_aligned.isnull().sum().sum()
-    snp_inf = (snp_aligned == float('inf')).sum().sum() + (snp_aligned == float('-inf')).sum().sum()
-    pheno_nan = pheno_aligned.isnull().sum().sum()
-    pheno_inf = (pheno_aligned == float('inf')).sum().sum() + (pheno_aligned == float('-inf')).sum().sum()
+    marker_qc, sample_call_rate = qc_impute(values, impute, block_size)
+    marker_qc.index = markers
+    pheno_values = pheno_aligned.select_dtypes('number').to_numpy(dtype=float)
+    pheno_nan = int(np.isnan(pheno_values).sum())
+    pheno_inf = int(np.isinf(pheno_values).sum())
+    snp_nan, snp_inf = int(marker_qc['missing'].sum()), int(marker_qc['inf'].sum())
     
     print(f"  SNP中的NaN: {snp_nan}")
     print(f"  SNP中的Inf: {snp_inf}")
     print(f"  表型中的NaN: {pheno_nan}")
     print(f"  表型中的Inf: {pheno_inf}")
     
+    print(f"  标记检出率: 最小 {marker_qc['call_rate'].min():.4f}, 平均 {marker_qc['call_rate'].mean():.4f}")
+    print(f"  样本检出率: 最小 {sample_call_rate.min():.4f}, 平均 {sample_call_rate.mean():.4f}")
+    dosage = marker_qc['maf'].notna()
+    if dosage.any():
+        print(f"  MAF: 最小 {marker_qc['maf'].min():.4f}, 中位数 {marker_qc['maf'].median():.4f}")
     if snp_nan > 0 or snp_inf > 0:
-        print("\n警告: SNP数据包含异常值，正在处理...")
-        # 填充SNP中的NaN为0
-        snp_aligned = snp_aligned.fillna(0)
-        # 替换Inf为最大/最小值
-        snp_aligned = snp_aligned.replace([float('inf'), float('-inf')], [snp_aligned.max().max(), snp_aligned.min().min()])
-        print("  已填充SNP数据中的异常值")
-    
-    # 7. 打印统计信息
+        print(f"\n警告: SNP数据包含异常值，已按{impute}填补")
+    
+    # 7. 过滤标记和样本
+    keep_markers = (marker_qc['call_rate'] >= min_call_rate) & (~dosage | (marker_qc['maf'] >= min_maf))
+    keep_samples = sample_call_rate >= min_sample_call_rate
+    if min_maf > 0 and not dosage.all():
+        print(f"\n注意: {int((~dosage).sum())}个标记不是0/1/2剂量，未按MAF过滤")
+    if dtype == 'int8' and not dosage[keep_markers].all():
+        print("\n错误: int8输出只适用于0/1/2剂量数据")
+        return False
+    marker_qc['kept'] = keep_markers
+    samples = common_samples[keep_samples]
+    kept_markers = np.flatnonzero(keep_markers.to_numpy())
+    print(f"\n过滤后: {len(samples)}/{len(common_samples)}个样本, {len(kept_markers)}/{len(markers)}个标记")
+    if len(samples) == 0 or len(kept_markers) == 0:
+        print("\n错误: 过滤后没有剩余的样本或标记!")
+        return False
+    pheno_aligned = pheno_aligned.loc[samples]
+    
+    # 8. 打印统计信息
     print("\n表型数据统计:")
     print(pheno_aligned.describe())
     
-    # 8. 保存对齐后的数据
-    snp_output = os.path.join(output_dir, 'snp_aligned.pkl')
+    # 9. 保存对齐后的数据
+    snp_output = os.path.join(output_dir, 'snp_aligned.' + output_format)
     pheno_output = os.path.join(output_dir, os.path.basename(pheno_file).replace('.tsv', '_aligned.tsv'))
+    marker_qc_output = os.path.join(output_dir, 'qc_markers.tsv')
+    sample_qc_output = os.path.join(output_dir, 'qc_samples.tsv')
     
     print(f"\n正在保存对齐后的数据...")
-    with open(snp_output, 'wb') as f:
-        pickle.dump(snp_aligned, f)
+    sample_rows = np.flatnonzero(keep_samples)
+    if output_format == 'npy':
+        writer = genotype_store.Writer(snp_output, len(samples), markers[kept_markers], dtype, samples)
+        for start in range(0, len(kept_markers), block_size):
+            writer.write_columns(start, values[np.ix_(sample_rows, kept_markers[start:start + block_size])])
+        writer.close()
+    else:
+        if len(sample_rows) < len(values) or len(kept_markers) < len(markers):
+            values = values[np.ix_(sample_rows, kept_markers)]
+        if dtype == 'int8':
+            values = np.rint(values)
+        snp_aligned = pd.DataFrame(values.astype(dtype, copy=False), index=samples, columns=markers[kept_markers],
+                                   copy=False)
+        with open(snp_output, 'wb') as f:
+            pickle.dump(snp_aligned, f, protocol=pickle.HIGHEST_PROTOCOL)
     pheno_aligned.to_csv(pheno_output, sep='\t')
+    marker_qc.to_csv(marker_qc_output, sep='\t', index_label='marker')
+    pd.DataFrame({'call_rate': sample_call_rate, 'kept': keep_samples},
+                 index=pd.Index(common_samples, name='sample')).to_csv(sample_qc_output, sep='\t')
     
     print(f"  SNP保存至: {snp_output}")
     print(f"  表型保存至: {pheno_output}")
+    print(f"  质量统计保存至: {marker_qc_output}, {sample_qc_output}")
     
     print("\n" + "="*60)
     print("数据预处理完成!".center(60))
@@ -104,16 +228,34 @@ def clean_and_align_data(snp_file, pheno_file, output_dir):
     
     return True
 
+
+def get_options():
+    parser = argparse.ArgumentParser(description='SNP和表型数据的质量控制、缺失值填补和对齐',
+                                     epilog='示例: python data_preprocessing.py "snp.pkl" "pheno.tsv" "aligned_data"')
+    parser.add_argument('snp_file', help='SNP文件 (.pkl, 或内存映射的基因型文件 .npy)')
+    parser.add_argument('pheno_file', help='表型文件 (.tsv)')
+    parser.add_argument('output_dir', help='输出目录')
+    parser.add_argument('--impute', choices=IMPUTE_METHODS, default='zero',
+                        help='SNP缺失值(NaN/Inf)的填补方式: zero填0, mean列均值, mode列众数(0/1/2剂量数据)，默认zero')
+    parser.add_argument('--min_call_rate', type=float, default=0.0, help='标记的最低检出率，默认0(不过滤)')
+    parser.add_argument('--min_maf', type=float, default=0.0, help='标记的最低次等位基因频率，默认0(不过滤)')
+    parser.add_argument('--min_sample_call_rate', type=float, default=0.0, help='样本的最低检出率，默认0(不过滤)')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='pkl',
+                        help='SNP输出格式: pkl(snp_aligned.pkl) 或 npy(内存映射的snp_aligned.npy)，默认pkl')
+    parser.add_argument('--dtype', choices=OUTPUT_DTYPES, default=None,
+                        help='输出数据类型，默认pkl为float64、npy为float32; int8仅适用于0/1/2剂量数据')
+    parser.add_argument('--block_size', type=int, default=2000, help='每次处理的标记列数，默认2000')
+    opt = parser.parse_args()
+    if opt.dtype is None:
+        opt.dtype = 'float64' if opt.output_format == 'pkl' else 'float32'
+    return opt
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print("使用方法: python data_preprocessing.py <snp.pkl> <pheno.tsv> <output_dir>")
-        print("\n示例:")
-        print('  python data_preprocessing.py "snp.pkl" "pheno.tsv" "aligned_data"')
-        sys.exit(1)
-    
-    snp_file = sys.argv[1]
-    pheno_file = sys.argv[2]
-    output_dir = sys.argv[3]
+    opt = get_options()
+    snp_file = opt.snp_file
+    pheno_file = opt.pheno_file
+    output_dir = opt.output_dir
     
     if not os.path.exists(snp_file):
         print(f"错误: SNP文件不存在: {snp_file}")
@@ -123,5 +265,6 @@ if __name__ == '__main__':
         print(f"错误: 表型文件不存在: {pheno_file}")
         sys.exit(1)
     
-    success = clean_and_align_data(snp_file, pheno_file, output_dir)
+    success = clean_and_align_data(snp_file, pheno_file, output_dir, opt.impute, opt.min_call_rate, opt.min_maf,
+                                   opt.min_sample_call_rate, opt.output_format, opt.dtype, opt.block_size)
     sys.exit(0 if success else 1)
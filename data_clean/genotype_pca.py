@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Genotype PCA
+对基因型矩阵(样本 x 位点)做主成分分析，得到DNNGP可直接使用的PC特征矩阵(与wheat599_pc95相同的PC1..PCk格式)，
+并保存投影(位点均值/标准差和载荷)，之后预测集的基因型可直接投影到同一组主成分上，无需重新计算。
+
+基因型按位点块从内存映射文件(.npy，见Scripts/genotype_store.py，可由tsv2pkl.py或geno2dosage.py生成)中流式读取，
+使用随机化SVD(幂迭代)：内存只与 样本数 x 成分数 和 块大小有关，可处理大于内存的面板；各块的矩阵乘法在多个线程中并行。
+块宽度由--cell_budget(所有线程同时处理的基因型个数)除以样本数和线程数得到，同时在途的块不超过线程数。
+
+使用方法:
+    python genotype_pca.py fit train.npy train_pc.pkl --projection train.pca.npz --variance 0.95
+    python genotype_pca.py project test.npy test_pc.pkl --projection train.pca.npz
+"""
+
+import os
+import sys
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+import genotype_store
+
+
+def open_genotype(path):
+    """(矩阵, 样本ID, 位点ID)；.npy以内存映射方式打开，.pkl读入内存"""
+    if genotype_store.is_store(path):
+        return genotype_store.load_array(path)
+    genotype = pd.read_pickle(path)
+    return genotype.to_numpy(), list(genotype.index), list(genotype.columns)
+
+
+def column_blocks(n_columns, block_size):
+    return [(start, min(start + block_size, n_columns)) for start in range(0, n_columns, block_size)]
+
+
+def block_width(n_samples, block_size, cell_budget, workers):
+    """每块的位点数：不超过block_size，且workers个块合计不超过cell_budget个基因型
+    (每个块在计算中有float64/float32副本，约每个基因型十几个字节)"""
+    return max(1, min(block_size, cell_budget // (max(n_samples, 1) * workers)))
+
+
+def bounded_map(func, blocks, workers):
+    """按块顺序返回func的结果，同时提交的块不超过workers个(executor.map会一次提交全部块，结果全部留在内存中)"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for bounds in blocks:
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, bounds))
+        while pending:
+            yield pending.popleft().result()
+
+
+def standardized(matrix, start, stop, mean, scale):
+    """读取一个位点块并中心化(可选标准化)为float32，缺失值按均值填补(即为0)"""
+    block = np.asarray(matrix[:, start:stop], dtype=np.float32) - mean[start:stop]
+    if scale is not None:
+        block /= scale[start:stop]
+    return np.nan_to_num(block, nan=0.0, posinf=0.0, neginf=0.0, copy=False)
+
+
+def block_sum(func, blocks, workers):
+    """对每个位点块计算func并求和；numpy运算释放GIL，因此线程即可利用多核"""
+    total = None
+    for part in bounded_map(func, blocks, workers):
+        total = part if total is None else total + part
+    return total
+
+
+def column_stats(matrix, blocks, workers):
+    """第一遍：每个位点的均值和标准差(忽略缺失值)"""
+    def stats(bounds):
+        block = np.asarray(matrix[:, bounds[0]:bounds[1]], dtype=np.float64)
+        block[~np.isfinite(block)] = np.nan
+        return bounds[0], np.nanmean(block, axis=0), np.nanstd(block, axis=0, ddof=1)
+
+    mean = np.zeros(matrix.shape[1])
+    std = np.zeros(matrix.shape[1])
+    with np.errstate(all='ignore'):
+        for start, block_mean, block_std in bounded_map(stats, blocks, workers):
+            mean[start:start + len(block_mean)] = block_mean
+            std[start:start + len(block_std)] = block_std
+    return np.nan_to_num(mean).astype(np.float32), np.nan_to_num(std).astype(np.float32)
+
+
+def sketch_rows(seed, start, stop, rank, tile=1024):
+    """随机投影矩阵Ω的第start..stop行；Ω按固定的tile行由(seed, tile序号)生成，结果与块宽度和线程数无关"""
+    tiles = [np.random.default_rng([seed, t]).standard_normal((tile, rank))
+             for t in range(start // tile, (stop - 1) // tile + 1)]
+    return np.concatenate(tiles)[start % tile:start % tile + stop - start]
+
+
+def fit(matrix, max_components=1000, variance=0.95, scale=False, oversample=10, power_iter=2,
+        block_size=10000, workers=None, seed=123, cell_budget=50000000):
+    """随机化SVD，返回投影参数 dict(mean, scale, components, explained_variance_ratio) 和样本的PC得分"""
+    n_samples, n_markers = matrix.shape
+    workers = workers or os.cpu_count() or 1
+    block_size = block_width(n_samples, block_size, cell_budget, workers)
+    print(f"每块处理 {block_size} 个位点, {workers} 个线程")
+    blocks = column_blocks(n_markers, block_size)
+    mean, std = column_stats(matrix, blocks, workers)
+    scale = np.where(std > 0, std, 1).astype(np.float32) if scale else None
+
+    total_var = block_sum(lambda b: float((standardized(matrix, *b, mean, scale).astype(np.float64) ** 2).sum()),
+                          blocks, workers)
+    rank = min(n_samples, n_markers, max_components + oversample)
+
+    # 值域估计: Y = X Ω
+    def sketch(bounds):
+        omega = sketch_rows(seed, bounds[0], bounds[1], rank)
+        return standardized(matrix, *bounds, mean, scale) @ omega.astype(np.float32)
+
+    Q = np.linalg.qr(block_sum(sketch, blocks, workers).astype(np.float64))[0]
+    for _ in range(power_iter):
+        # 幂迭代: Y = X X^T Q，每次一遍读取
+        def power(bounds, Q=Q.astype(np.float32)):
+            block = standardized(matrix, *bounds, mean, scale)
+            return block @ (block.T @ Q)
+        Q = np.linalg.qr(block_sum(power, blocks, workers).astype(np.float64))[0]
+
+    # B = Q^T X 太大，不保存；B B^T (rank x rank)的特征分解给出奇异值和左奇异向量
+    def gram(bounds, Q=Q.astype(np.float32)):
+        product = Q.T @ standardized(matrix, *bounds, mean, scale)
+        return product.astype(np.float64) @ product.T.astype(np.float64)
+
+    eigval, eigvec = np.linalg.eigh(block_sum(gram, blocks, workers))
+    order = np.argsort(eigval)[::-1]
+    eigval, eigvec = np.clip(eigval[order], 0, None), eigvec[:, order]
+    ratio = eigval / total_var if total_var > 0 else np.zeros_like(eigval)
+
+    cumulative = np.cumsum(ratio)
+    k = int(np.searchsorted(cumulative, variance) + 1) if variance < 1 else len(ratio)
+    k = max(1, min(k, max_components, int((eigval > 0).sum()) or 1))
+    if cumulative[k - 1] < variance:
+        print(f"警告: 前{k}个主成分只解释了{cumulative[k - 1]:.2%}的方差，未达到{variance:.0%}，可增大--max_components")
+
+    left = Q @ eigvec[:, :k]
+    singular = np.sqrt(eigval[:k])
+    inv = np.divide(1.0, singular, out=np.zeros_like(singular), where=singular > 0)
+
+    # 载荷(位点 x k): V = X^T U / S，再一遍读取
+    components = np.zeros((n_markers, k), dtype=np.float32)
+    def loadings(bounds, UdS=(left * inv).astype(np.float32)):
+        components[bounds[0]:bounds[1]] = standardized(matrix, *bounds, mean, scale).T @ UdS
+    for _ in bounded_map(loadings, blocks, workers):
+        pass
+
+    # 符号约定: 每个主成分中绝对值最大的载荷为正，结果可重复
+    signs = np.sign(components[np.abs(components).argmax(axis=0), np.arange(k)])
+    signs[signs == 0] = 1
+    components *= signs
+    scores = (left * singular * signs).astype(np.float32)
+    projection = {'mean': mean, 'scale': scale, 'components': components, 'explained_variance_ratio': ratio[:k]}
+    return projection, scores
+
+
+def project(matrix, markers, projection, block_size=10000, workers=None, cell_budget=50000000):
+    """把新的基因型投影到已保存的主成分上；按位点ID对齐，缺少的位点按训练集均值处理"""
+    position = {name: i for i, name in enumerate(projection['markers'])}
+    columns = np.array([position.get(name, -1) for name in markers])
+    missing = len(projection['markers']) - int((columns >= 0).sum())
+    if missing:
+        print(f"警告: 有 {missing} 个训练集位点不在输入中，按均值处理")
+    mean, components = projection['mean'], projection['components']
+    scale = projection.get('scale')
+
+    def partial(bounds):
+        keep = columns[bounds[0]:bounds[1]] >= 0
+        if not keep.any():
+            return np.zeros((matrix.shape[0], components.shape[1]), dtype=np.float32)
+        index = columns[bounds[0]:bounds[1]][keep]
+        block = np.asarray(matrix[:, bounds[0]:bounds[1]], dtype=np.float32)[:, keep] - mean[index]
+        if scale is not None:
+            block /= scale[index]
+        block = np.nan_to_num(block, nan=0.0, posinf=0.0, neginf=0.0, copy=False)
+        return block @ components[index]
+
+    workers = workers or os.cpu_count() or 1
+    block_size = block_width(matrix.shape[0], block_size, cell_budget, workers)
+    return block_sum(partial, column_blocks(matrix.shape[1], block_size), workers)
+
+
+def save_projection(path, markers, projection):
+    arrays = {'markers': np.array(markers, dtype=str), 'mean': projection['mean'],
+              'components': projection['components'],
+              'explained_variance_ratio': projection['explained_variance_ratio']}
+    if projection['scale'] is not None:
+        arrays['scale'] = projection['scale']
+    np.savez(path, **arrays)
+
+
+def load_projection(path):
+    with np.load(path) as data:
+        projection = {name: data[name] for name in data.files}
+    projection['markers'] = list(projection['markers'])
+    return projection
+
+
+def save_scores(path, samples, scores):
+    """PC特征矩阵: .pkl(DataFrame)、.tsv(与wheat599_pc95.tsv格式相同)或.npy(float32基因型文件)"""
+    pcs = pd.DataFrame(scores, index=pd.Index(samples), columns=[f"PC{i + 1}" for i in range(scores.shape[1])])
+    if path.endswith('.tsv'):
+        pcs.index.name = 'ID'
+        pcs.to_csv(path, sep='\t')
+    elif genotype_store.is_store(path):
+        genotype_store.save(path, pcs)
+    else:
+        pcs.to_pickle(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='基因型矩阵的主成分分析(流式随机化SVD)，生成PC特征矩阵并保存/应用投影',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+    python genotype_pca.py fit wheat599.train.npy wheat599_pc95.pkl --projection wheat599.pca.npz
+    python genotype_pca.py project wheat599.test.npy wheat599_test_pc95.pkl --projection wheat599.pca.npz
+        """
+    )
+    parser.add_argument('mode', choices=['fit', 'project'], help='fit: 计算主成分; project: 使用已保存的投影')
+    parser.add_argument('input', help='输入的基因型文件(.npy或.pkl，样本 x 位点)')
+    parser.add_argument('output', help='输出的PC特征矩阵(.pkl、.tsv或.npy)')
+    parser.add_argument('--projection', required=True, help='投影文件(.npz)，fit时写入，project时读取')
+    parser.add_argument('--variance', type=float, default=0.95, help='保留的累计解释方差比例，默认0.95')
+    parser.add_argument('--max_components', type=int, default=1000, help='最多计算的主成分数，默认1000')
+    parser.add_argument('--scale', action='store_true', help='按位点标准差标准化(默认只中心化)')
+    parser.add_argument('--power_iter', type=int, default=2, help='随机化SVD的幂迭代次数，默认2')
+    parser.add_argument('--block_size', type=int, default=10000, help='每块读取的最多位点数，默认10000')
+    parser.add_argument('--cell_budget', type=int, default=50000000,
+                        help='所有线程同时处理的最多基因型个数(样本数 x 块位点数 x 线程数)，限制内存占用，默认50000000')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='并行线程数，默认CPU核数')
+    parser.add_argument('--seed', type=int, default=123, help='随机种子，默认123')
+
+    args = parser.parse_args()
+
+    try:
+        matrix, samples, markers = open_genotype(args.input)
+        print(f"基因型矩阵: {len(samples)} 个样本, {len(markers)} 个位点")
+        if args.mode == 'fit':
+            projection, scores = fit(matrix, args.max_components, args.variance, args.scale,
+                                     power_iter=args.power_iter, block_size=args.block_size,
+                                     workers=args.workers, seed=args.seed, cell_budget=args.cell_budget)
+            save_projection(args.projection, markers, projection)
+            explained = projection['explained_variance_ratio'].sum()
+            print(f"保留 {scores.shape[1]} 个主成分, 累计解释方差 {explained:.2%}")
+            print(f"投影已保存: {args.projection}")
+        else:
+            scores = project(matrix, markers, load_projection(args.projection), args.block_size, args.workers,
+                             args.cell_budget)
+        save_scores(args.output, samples, scores)
+        print(f"PC特征矩阵已保存: {args.output}")
+    except Exception as e:
+        print(f"错误: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
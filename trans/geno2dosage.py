@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+VCF/HMP to Dosage Converter
+将VCF或Hapmap格式(HMP)的基因型直接转换为0/1/2 int8剂量矩阵(样本 x 位点)，
+输出为DNNGP可直接读取的内存映射基因型文件(.npy + .samples.txt + .markers.txt)，
+可直接用于 dnngp_runner.py --snp 和 Pre_runner.py --SNP。
+
+使用方法:
+    python geno2dosage.py input.vcf output.npy
+    python geno2dosage.py input.hmp.txt output.npy --impute mode
+"""
+
+import os
+import sys
+import gzip
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+import genotype_store
+
+MISSING = -1
+HMP_MISSING = ('NA', '--', 'NN')
+
+
+def open_text(path):
+    """支持普通文本和.gz压缩文件"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+
+def detect_format(path):
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return 'vcf' if name.endswith('.vcf') else 'hmp'
+
+
+def read_header(handle, fmt):
+    """跳过注释行，返回样本名列表"""
+    for line in handle:
+        if fmt == 'vcf' and line.startswith('##'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        return fields[9:] if fmt == 'vcf' else fields[11:]
+    raise ValueError("文件中没有表头")
+
+
+def site_id(fields, fmt):
+    """位点ID: VCF使用ID列(为'.'时使用CHROM_POS)，HMP使用rs#"""
+    if fmt == 'vcf':
+        return fields[2] if fields[2] != '.' else f"{fields[0]}_{fields[1]}"
+    return fields[0]
+
+
+def valid_site(fields, fmt):
+    # 与hmp2vcf.py一致：等位基因格式不正确的HMP位点被跳过
+    return fmt == 'vcf' or '/' in fields[1]
+
+
+def scan_sites(path, fmt):
+    """第一遍扫描：只读取每行的前几列，得到样本名和位点ID"""
+    n_fixed = 9 if fmt == 'vcf' else 11
+    with open_text(path) as handle:
+        samples = read_header(handle, fmt)
+        sites = []
+        for line in handle:
+            if not line.strip():
+                continue
+            fields = line.split('\t', n_fixed)
+            if valid_site(fields, fmt):
+                sites.append(site_id(fields, fmt))
+    return samples, sites
+
+
+def iter_blocks(path, fmt, block_size, n_samples):
+    """按块读取位点，每块返回各行的字段列表；基因型列数与样本数不符的行报告行号"""
+    n_fixed = 9 if fmt == 'vcf' else 11
+    with open_text(path) as handle:
+        lines = enumerate(handle, 1)
+        for number, line in lines:  # 跳过注释行和表头
+            if not (fmt == 'vcf' and line.startswith('##')):
+                break
+        block = []
+        for number, line in lines:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != n_fixed + n_samples:
+                raise ValueError(f"第{number}行有{len(fields) - n_fixed}个基因型列, 表头有{n_samples}个样本")
+            if not valid_site(fields, fmt):
+                continue
+            block.append(fields)
+            if len(block) == block_size:
+                yield block
+                block = []
+        if block:
+            yield block
+
+
+def gt_dosage(gt):
+    """单个VCF GT字符串的剂量(非0等位基因个数)，含'.'则为缺失"""
+    alleles = gt.replace('|', '/').split('/')
+    if not gt or any(a in ('', '.') for a in alleles):
+        return MISSING
+    return sum(a != '0' for a in alleles)
+
+
+def decode_vcf_block(block, n_samples):
+    """VCF块 -> 位点 x 样本 int8剂量矩阵，按唯一GT查表，避免逐个基因型调用Python函数"""
+    cells = np.array([fields[9:9 + n_samples] for fields in block])
+    gts = np.char.partition(cells, ':')[..., 0]
+    tokens, inverse = np.unique(gts, return_inverse=True)
+    table = np.array([gt_dosage(t) for t in tokens], dtype=np.int8)
+    return table[inverse.reshape(gts.shape)]
+
+
+def allele_code(allele):
+    return ord(allele) if len(allele) == 1 else -2
+
+
+def decode_hmp_block(block, n_samples):
+    """HMP块 -> 位点 x 样本 int8剂量矩阵(替代等位基因个数)，规则与hmp2vcf.convert_genotype一致"""
+    cells = np.array([fields[11:11 + n_samples] for fields in block], dtype='U3')
+    alleles = [fields[1].split('/') for fields in block]
+    ref = np.array([allele_code(a[0]) for a in alleles])[:, None]
+    alt = np.array([allele_code(a[1]) for a in alleles])[:, None]
+    codes = cells.view(np.uint32).reshape(cells.shape + (3,)).astype(np.int64)
+    c0, c1, c2 = codes[..., 0], codes[..., 1], codes[..., 2]
+    valid = (c2 == 0) & ((c0 == ref) | (c0 == alt)) & ((c1 == ref) | (c1 == alt))
+    valid &= ~np.isin(cells, HMP_MISSING)
+    dosage = (c0 == alt).astype(np.int8) + (c1 == alt).astype(np.int8)
+    return np.where(valid, dosage, MISSING).astype(np.int8)
+
+
+def impute(dosage, method):
+    """按位点填补缺失值: mean(四舍五入的均值) 或 mode(众数)；全部缺失的位点填0"""
+    missing = dosage == MISSING
+    if not missing.any():
+        return dosage
+    if method == 'mode':
+        counts = np.stack([(dosage == d).sum(axis=1) for d in (0, 1, 2)], axis=1)
+        fill = counts.argmax(axis=1)
+    else:
+        called = (~missing).sum(axis=1)
+        total = np.where(missing, 0, dosage).sum(axis=1, dtype=np.int64)
+        fill = np.rint(np.divide(total, called, out=np.zeros(len(dosage)), where=called > 0))
+    return np.where(missing, fill[:, None].astype(np.int8), dosage)
+
+
+def convert(input_file, output_file, fmt=None, impute_method='mean', block_size=5000, dtype='int8',
+            cell_budget=5000000):
+    """主转换函数
+
+    每块的位点数不超过block_size，且位点数 x 样本数不超过cell_budget：
+    块内每个基因型在解码前是一个Python字符串(约60字节)，按单元格数限制块大小使内存不随样本数增长。
+    """
+    fmt = fmt or detect_format(input_file)
+    if not output_file.endswith('.npy'):
+        output_file = os.path.splitext(output_file)[0] + '.npy'
+    print(f"正在扫描{fmt.upper()}文件: {input_file}")
+    samples, sites = scan_sites(input_file, fmt)
+    print(f"检测到 {len(samples)} 个样本, {len(sites)} 个位点")
+    block_size = max(1, min(block_size, cell_budget // max(len(samples), 1)))
+    print(f"每块处理 {block_size} 个位点")
+
+    writer = genotype_store.Writer(output_file, len(samples), sites, dtype=dtype, samples=samples)
+    decode = decode_vcf_block if fmt == 'vcf' else decode_hmp_block
+    start = 0
+    n_missing = 0
+    for block in iter_blocks(input_file, fmt, block_size, len(samples)):
+        dosage = decode(block, len(samples))
+        n_missing += int((dosage == MISSING).sum())
+        dosage = impute(dosage, impute_method)
+        writer.write_columns(start, dosage.T)
+        start += len(block)
+        print(f"已处理 {start} 个位点...")
+    writer.close()
+
+    print(f"转换完成! 共 {start} 个位点, 填补缺失基因型 {n_missing} 个")
+    print(f"剂量矩阵已保存: {output_file}")
+    return output_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='将VCF/HMP转换为DNNGP可读取的0/1/2剂量矩阵',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+    python geno2dosage.py maize1k.train.vcf maize1k.train.npy
+    python geno2dosage.py maize1k.train.hmp.txt maize1k.train.npy --impute mode
+        """
+    )
+
+    parser.add_argument('input', help='输入的VCF或HMP文件路径(可为.gz)')
+    parser.add_argument('output', help='输出的基因型文件路径(.npy)')
+    parser.add_argument('--format', choices=['vcf', 'hmp'], default=None, help='输入格式，默认按文件扩展名判断')
+    parser.add_argument('--impute', choices=['mean', 'mode'], default='mean', help='缺失基因型填补方法，默认mean')
+    parser.add_argument('--block_size', type=int, default=5000, help='每块处理的最多位点数，默认5000')
+    parser.add_argument('--cell_budget', type=int, default=5000000,
+                        help='每块最多的基因型个数(位点数 x 样本数)，限制内存占用，默认5000000')
+    parser.add_argument('--dtype', choices=genotype_store.DTYPES, default='int8', help='输出矩阵类型，默认int8')
+
+    args = parser.parse_args()
+
+    try:
+        convert(args.input, args.output, args.format, args.impute, args.block_size, args.dtype, args.cell_budget)
+    except Exception as e:
+        print(f"错误: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,12 @@ HMP to VCF Converter
     python hmp2vcf.py input.hmp.txt output.vcf
 """
 
+import os
 import sys
 import argparse
+import multiprocessing
 from datetime import datetime
+import numpy as np
 
 
 def parse_hmp_header(header_line):
@@ -49,8 +52,185 @@ def convert_genotype(geno, ref_allele, alt_allele):
     return './.'
 
 
-def hmp_to_vcf(hmp_file, vcf_file):
-    """主转换函数"""
+# 每种编码对应的VCF基因型(含分隔用的制表符)，每个4字节当作一个uint32取用：0=0/0, 1=0/1, 2=1/1, 3=./.
+GT_WORDS = np.frombuffer(b'0/0\t0/1\t1/1\t./.\t', dtype=np.uint32)
+TAB, N, A, DASH, NEWLINE = ord('\t'), ord('N'), ord('A'), ord('-'), ord('\n')
+
+
+def pair_codes():
+    """两个字符的类别(bit0=等于参考, bit1=等于替代)组合成的16种情况 -> 编码，优先级与convert_genotype相同"""
+    table = np.full(16, 3, dtype=np.uint8)
+    for x0 in range(4):
+        for x1 in range(4):
+            if x0 & 1 and x1 & 1:
+                table[x0 << 2 | x1] = 0
+            elif x0 & 2 and x1 & 2:
+                table[x0 << 2 | x1] = 2
+            elif (x0 & 1 and x1 & 2) or (x0 & 2 and x1 & 1):
+                table[x0 << 2 | x1] = 1
+    return table
+
+
+PAIR_CODES = pair_codes()
+
+
+def allele_code(allele):
+    """单字符等位基因的Unicode码，其他情况返回一个不会与任何基因型字符相等的值"""
+    return ord(allele) if len(allele) == 1 else -1
+
+
+def genotype_codes(c0, c1, two, ref, alt):
+    """按convert_genotype的判断顺序，一次计算整块基因型的编码: 两个字符各自与参考/替代比较，组合后查表"""
+    x0 = (c0 == ref).view(np.uint8) | ((c0 == alt).view(np.uint8) << 1)
+    x1 = (c1 == ref).view(np.uint8) | ((c1 == alt).view(np.uint8) << 1)
+    codes = PAIR_CODES.take((x0 << 2) | x1)
+    codes[~two] = 3
+    # NA/NN/--只有在N或-本身是等位基因的位点上才可能被判为非缺失，只对这些位点检查
+    rows = np.flatnonzero(((ref == N) | (alt == N) | (ref == DASH) | (alt == DASH)).any(axis=1))
+    if len(rows):
+        r0, r1 = c0[rows], c1[rows]
+        codes[rows] = np.where(((r0 == N) & ((r1 == A) | (r1 == N))) | ((r0 == DASH) & (r1 == DASH)), 3, codes[rows])
+    return codes
+
+
+def pair_genotype_codes(pairs, ref, alt):
+    """快速路径的编码：pairs是每个基因型两个字符组成的uint16(第一个字符在低字节)，每种基因型只需一次比较
+
+    与genotype_codes结果相同；参考与替代相同时替代视为不匹配，保证纯合参考优先。
+    """
+    ref, alt = ref.astype(np.uint16), alt.astype(np.uint16)
+    alt = np.where(alt == ref, TAB, alt)
+    codes = np.full(pairs.shape, 3, dtype=np.uint8)
+    codes -= (pairs == (ref | ref << 8)).view(np.uint8) * np.uint8(3)
+    codes -= (pairs == (alt | alt << 8)).view(np.uint8)
+    codes -= ((pairs == (ref | alt << 8)) | (pairs == (alt | ref << 8))).view(np.uint8) << 1
+    rows = np.flatnonzero(((ref == N) | (alt == N) | (ref == DASH) | (alt == DASH)).any(axis=1))
+    if len(rows):
+        missing = np.isin(pairs[rows], [N | A << 8, N | N << 8, DASH | DASH << 8])
+        codes[rows] = np.where(missing, 3, codes[rows])
+    return codes
+
+
+def format_sites(sites, codes):
+    """由编码生成VCF行，NS/AF与逐行计算的结果完全一致
+
+    基因型部分整块由查表得到(每行末尾的制表符换成换行符)，Python只拼接每行的前9列。
+    """
+    alleles = [fields[1].split('/') for fields in sites]
+    non_missing = (codes.shape[1] - np.count_nonzero(codes == 3, axis=1)).tolist()
+    alt_count = (np.count_nonzero(codes == 1, axis=1) + 2 * np.count_nonzero(codes == 2, axis=1)).tolist()
+    if codes.shape[1]:
+        gt_text = GT_WORDS[codes].view(np.uint8).reshape(len(sites), -1)
+        gt_text[:, -1] = NEWLINE
+    else:  # 没有基因型列的位点：只有前9列和换行符
+        gt_text = np.full((len(sites), 1), NEWLINE, dtype=np.uint8)
+    width = gt_text.shape[1]
+    gt_str = gt_text.tobytes().decode('ascii')
+    lines = []
+    for i, (fields, allele_list, ns, alts) in enumerate(zip(sites, alleles, non_missing, alt_count)):
+        af = alts / (2 * ns) if ns > 0 else 0.0
+        info = f"NS={ns};AF={af:.4f}"
+        lines.append(f"{fields[2]}\t{fields[3]}\t{fields[0]}\t{allele_list[0]}\t{allele_list[1]}\t.\tPASS\t{info}\tGT\t"
+                     + gt_str[i * width:(i + 1) * width])
+    return lines
+
+
+def site_alleles(sites, dtype=np.int64, no_match=-1):
+    """每个位点的参考/替代等位基因编码(位点 x 1)，不是单字符的等位基因编码为no_match"""
+    alleles = [fields[1].split('/') for fields in sites]
+    codes = [(allele_code(a[0]), allele_code(a[1])) for a in alleles]
+    limit = np.iinfo(dtype).max
+    codes = np.array([[c if 0 <= c <= limit else no_match for c in pair] for pair in codes], dtype=dtype)
+    return codes[:, :1], codes[:, 1:]
+
+
+def convert_fixed_width(sites):
+    """快速路径：所有基因型都是两个ASCII字符时，直接把整块基因型文本按(位点, 样本)的两字符uint16处理
+
+    返回(VCF行列表, 不满足条件需要走通用路径的行号)
+    """
+    k = (len(sites[0][11]) + 1) // 3
+    text = ('\t'.join(fields[11] for fields in sites) + '\t').encode('ascii')
+    chars = np.frombuffer(text, dtype=np.uint8).reshape(len(sites), -1)
+    # 制表符总数正好且都在每个基因型的第三个字符上时整块合格，否则逐行检查
+    if text.count(b'\t') == len(sites) * k and text[2::3] == b'\t' * (len(sites) * k):
+        ok = np.ones(len(sites), dtype=bool)
+    else:
+        tabs = chars == TAB
+        ok = (np.count_nonzero(tabs, axis=1) == k) & tabs[:, 2::3].all(axis=1)
+    # 基因型字符不可能是制表符，因此用它表示"不匹配任何字符"的等位基因
+    ref, alt = site_alleles(sites, np.uint8, TAB)
+    pairs = np.ndarray((len(sites), k), dtype='<u2', buffer=text, strides=(3 * k, 3))
+    codes = pair_genotype_codes(pairs, ref, alt)
+    good = np.flatnonzero(ok)
+    lines = format_sites([sites[i] for i in good], codes[good]) if len(good) else []
+    return dict(zip(good.tolist(), lines)), np.flatnonzero(~ok).tolist()
+
+
+def convert_general(sites):
+    """通用路径：基因型个数相同的一组位点，按前三个字符向量化比较"""
+    cells = np.array([fields[11:] for fields in sites], dtype='U3')
+    ref, alt = site_alleles(sites)
+    # 每个基因型的前三个字符；长度为2的基因型第三个字符为0
+    chars = cells.view(np.uint32).reshape(cells.shape + (3,)).astype(np.int64)
+    c0, c1 = chars[..., 0], chars[..., 1]
+    two = (c0 != 0) & (c1 != 0) & (chars[..., 2] == 0)
+    return format_sites(sites, genotype_codes(c0, c1, two, ref, alt))
+
+
+def convert_chunk(lines):
+    """转换一块HMP行，返回(VCF文本, SNP数, 警告信息)，输出顺序与输入一致"""
+    sites = []
+    warnings = []
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = line.strip().split('\t', 11)
+        if '/' not in fields[1]:
+            # 如果没有/分隔符，跳过该行
+            warnings.append(f"警告: SNP {fields[0]} 的等位基因格式不正确: {fields[1]}")
+            continue
+        sites.append(fields)
+
+    out = [None] * len(sites)
+    # 基因型文本长度相同且可能全是两字符基因型的行，按长度分组走快速路径
+    fixed = {}
+    general = []
+    for i, fields in enumerate(sites):
+        if len(fields) == 12 and len(fields[11]) % 3 == 2 and fields[11].isascii():
+            fixed.setdefault(len(fields[11]), []).append(i)
+        else:
+            general.append(i)
+    for indices in fixed.values():
+        done, rejected = convert_fixed_width([sites[i] for i in indices])
+        for j, text in done.items():
+            out[indices[j]] = text
+        general.extend(indices[j] for j in rejected)
+
+    # 其余行完整拆分后按基因型个数分组
+    groups = {}
+    for i in general:
+        fields = sites[i][:11] + sites[i][11].split('\t') if len(sites[i]) == 12 else sites[i]
+        groups.setdefault(len(fields), []).append((i, fields))
+    for members in groups.values():
+        for (i, _), text in zip(members, convert_general([fields for _, fields in members])):
+            out[i] = text
+    return "".join(out), len(sites), warnings
+
+
+def read_chunks(handle, chunk_size):
+    chunk = []
+    for line in handle:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def hmp_to_vcf(hmp_file, vcf_file, workers=1, chunk_size=2000):
+    """主转换函数，workers>1时各数据块在多个进程中转换，输出顺序保持不变"""
     print(f"正在读取HMP文件: {hmp_file}")
     
     with open(hmp_file, 'r') as hmp_in, open(vcf_file, 'w') as vcf_out:
@@ -71,69 +251,22 @@ def hmp_to_vcf(hmp_file, vcf_file):
         # 写入VCF列名
         vcf_out.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n")
         
-        # 处理每一行SNP数据
+        # 分块处理SNP数据
         snp_count = 0
-        for line in hmp_in:
-            if not line.strip():
-                continue
-            
-            fields = line.strip().split('\t')
-            
-            # 提取固定字段
-            snp_id = fields[0]      # rs#
-            alleles = fields[1]     # alleles (e.g., "A/G")
-            chrom = fields[2]       # chromosome
-            pos = fields[3]         # position
-            genotypes = fields[11:] # 基因型数据
-            
-            # 解析等位基因
-            if '/' in alleles:
-                allele_list = alleles.split('/')
-                ref_allele = allele_list[0]
-                alt_allele = allele_list[1]
-            else:
-                # 如果没有/分隔符，跳过该行
-                print(f"警告: SNP {snp_id} 的等位基因格式不正确: {alleles}")
-                continue
-            
-            # 转换基因型
-            vcf_genotypes = []
-            non_missing = 0
-            alt_count = 0
-            total_alleles = 0
-            
-            for geno in genotypes:
-                vcf_gt = convert_genotype(geno, ref_allele, alt_allele)
-                vcf_genotypes.append(vcf_gt)
-                
-                # 计算统计信息
-                if vcf_gt != './.':
-                    non_missing += 1
-                    if vcf_gt == '0/1':
-                        alt_count += 1
-                        total_alleles += 2
-                    elif vcf_gt == '1/1':
-                        alt_count += 2
-                        total_alleles += 2
-                    elif vcf_gt == '0/0':
-                        total_alleles += 2
-            
-            # 计算等位基因频率
-            if total_alleles > 0:
-                af = alt_count / total_alleles
-            else:
-                af = 0.0
-            
-            # 构建INFO字段
-            info = f"NS={non_missing};AF={af:.4f}"
-            
-            # 写入VCF行
-            vcf_line = f"{chrom}\t{pos}\t{snp_id}\t{ref_allele}\t{alt_allele}\t.\tPASS\t{info}\tGT\t" + "\t".join(vcf_genotypes) + "\n"
-            vcf_out.write(vcf_line)
-            
-            snp_count += 1
-            if snp_count % 1000 == 0:
+        chunks = read_chunks(hmp_in, chunk_size)
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            results = pool.imap(convert_chunk, chunks) if pool is not None else map(convert_chunk, chunks)
+            for text, count, warnings in results:
+                for warning in warnings:
+                    print(warning)
+                vcf_out.write(text)
+                snp_count += count
                 print(f"已处理 {snp_count} 个SNP...")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
     
     print(f"转换完成! 共处理 {snp_count} 个SNP")
     print(f"VCF文件已保存: {vcf_file}")
@@ -152,11 +285,13 @@ def main():
     
     parser.add_argument('input', help='输入的HMP文件路径')
     parser.add_argument('output', help='输出的VCF文件路径')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行转换的进程数，默认为CPU核数')
+    parser.add_argument('--chunk_size', type=int, default=2000, help='每块的SNP行数，默认2000')
     
     args = parser.parse_args()
     
     try:
-        hmp_to_vcf(args.input, args.output)
+        hmp_to_vcf(args.input, args.output, args.workers, args.chunk_size)
     except Exception as e:
         print(f"错误: {e}")
         sys.exit(1)